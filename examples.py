@@ -226,7 +226,7 @@ def RunFullPipelineExample():
 
         # Overlay
         Log.info("Create Overlay ...")
-        vis_overlay = draw_overlay(warper, lane_fitting, undistorted, warped)
+        vis_overlay = draw_overlay(warper, lane_fitting, undistorted)
 
         # Concatenate
         vis_edges = np.dstack((edges, edges, edges))
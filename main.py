@@ -1,5 +1,6 @@
 from src.logger import Log
 from src.lane_tracker import LaneLinesTracker
+from src.batch import process_images
 from examples import *
 
 
@@ -14,6 +15,14 @@ def ProcessProjectVideo(subclip_seconds=None):
     return output_file
 
 
+def ProcessTestImages(workers=None):
+    Log.section("Test Images")
+
+    results_file = "output_images/test_images_results.csv"
+    process_images("test_images", "output_images", results_file, workers)
+    return results_file
+
+
 def main():
     Log.debug_enabled = False
     # RunCalibrationExample()
@@ -22,6 +31,7 @@ def main():
     # RunPerspectiveTransformExample()
     # RunLaneFittingExample()
     # RunFullPipelineExample()
+    # ProcessTestImages()
 
     ProcessProjectVideo(subclip_seconds=None)
 
@@ -0,0 +1,110 @@
+import os
+import csv
+import glob
+import multiprocessing
+
+import cv2
+
+from . import parallel
+from .logger import Log
+from .calibration import GetCalibratedCamera
+
+RESULT_COLUMNS = [
+    "file",
+    "left_a",
+    "left_b",
+    "left_c",
+    "right_a",
+    "right_b",
+    "right_c",
+    "curvature_left",
+    "curvature_right",
+    "position",
+    "error",
+]
+
+
+def _process_file(fname, output_dir):
+    """Processes one image file, returns its results table row."""
+    tracker = parallel._tracker
+    row = dict(file=fname)
+    try:
+        image = cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2RGB)
+
+        # still images are unrelated to each other
+        tracker.reset()
+        result = tracker.process_frame(image)
+
+        row.update(zip(RESULT_COLUMNS[1:4], result.left_fit))
+        row.update(zip(RESULT_COLUMNS[4:7], result.right_fit))
+        row["curvature_left"], row["curvature_right"] = result.curvature
+        row["position"] = result.position
+
+        if output_dir and result.overlay is not None:
+            out_name = os.path.join(output_dir, "overlay_" + os.path.basename(fname))
+            cv2.imwrite(out_name, cv2.cvtColor(result.overlay, cv2.COLOR_RGB2BGR))
+    except Exception as e:
+        row["error"] = repr(e)
+    return row
+
+
+def list_images(images):
+    """Accepts a directory, a glob pattern or a list of files."""
+    if isinstance(images, str):
+        if os.path.isdir(images):
+            images = os.path.join(images, "*.jpg")
+        images = glob.glob(images)
+    return sorted(images)
+
+
+def process_images(
+    images,
+    output_dir="output_images",
+    results_file=None,
+    workers=None,
+    tracker_class=None,
+    **tracker_config
+):
+    """
+    Runs the LaneLinesTracker pipeline on still images in a pool of worker
+    processes. The calibration and remap tables are solved and cached here,
+    workers load them from the cache (memory-mapped, see Cache).
+
+    Overlays are written to output_dir (None to skip them) and one results row
+    per image is written to results_file (CSV), in input order. Returns the rows.
+    """
+    if tracker_class is None:
+        from .lane_tracker import LaneLinesTracker as tracker_class
+
+    fnames = list_images(images)
+    workers = workers or multiprocessing.cpu_count()
+    Log.subsection("Processing %d images on %d workers ..." % (len(fnames), workers))
+    if not fnames:
+        return []
+
+    # solve the calibration once, for the resolution of the first image
+    camera = GetCalibratedCamera()
+    h, w = cv2.imread(fnames[0]).shape[:2]
+    camera.get_undistort_maps(w, h)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    init_args = (tracker_class, tracker_config)
+    tasks = [(fname, output_dir) for fname in fnames]
+    chunksize = max(1, len(tasks) // (4 * workers))
+    with multiprocessing.Pool(workers, parallel._init_worker, init_args) as pool:
+        rows = pool.starmap(_process_file, tasks, chunksize)
+
+    n_errors = sum(1 for row in rows if row.get("error"))
+    if n_errors:
+        Log.warn("%d images failed, see the error column" % n_errors)
+
+    if results_file:
+        Log.info("Saving results to %s" % results_file)
+        with open(results_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, RESULT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return rows
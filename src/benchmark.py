@@ -0,0 +1,298 @@
+"""
+Reproducible stage benchmarks, without the project video:
+
+    python -m src.benchmark --save benchmarks/baseline.json
+    python -m src.benchmark --baseline benchmarks/baseline.json --tolerance 0.25
+
+Each stage (undistort, detect, warp, warp_points, find_lane_pixels,
+fit_polynomial, overlay) runs in isolation, and the whole pipeline end to end,
+on deterministic synthetic road frames (several resolutions and edge
+densities) and on the test images. A stage regresses when its median time exceeds the baseline by
+more than the tolerance; the exit status is 1 if any stage regresses.
+
+Baselines are only comparable on the same machine and library versions, which
+are saved with them.
+"""
+
+import os
+import sys
+import json
+import platform
+import argparse
+
+import cv2
+import numpy as np
+
+from .logger import Log
+from .calibration import GetCalibratedCamera, WarpMachine
+from .filtering import EdgeDetector
+from .lane_fitting import LaneFit
+from .lane_tracker import LaneLinesTracker, draw_overlay
+from .profiler import Profiler
+from .batch import list_images
+from .visualization import VisLevel
+
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+
+# clutter (shadows, cracks, markings) per frame, relative to the lane lines
+DENSITIES = dict(low=0.25, medium=1.0, high=4.0)
+
+# reference geometry of the synthetic frames, see WarpMachine
+REF_W = 1280
+REF_H = WarpMachine.h
+
+
+def lane_curve(y, base, curvature, h):
+    """x of a lane line at rows y, bending with the distance to the bottom."""
+    return base + curvature * ((h - y) / h) ** 2
+
+
+def synthetic_frame(w, h, density, seed=0):
+    """
+    Deterministic RGB road frame: sky, noisy asphalt, a yellow left line, a
+    dashed white right line (drawn in bird's-eye space and projected like the
+    camera sees them) and random clutter.
+    """
+    rng = np.random.default_rng(seed)
+    sx = w / REF_W
+    sy = h / REF_H
+    horizon = int(WarpMachine.top * sy)
+
+    image = np.empty((h, w, 3), np.uint8)
+    image[:horizon] = (140, 175, 205)
+    asphalt = rng.normal(95, 6, size=(h - horizon, w, 1))
+    image[horizon:] = np.clip(asphalt, 0, 255).astype(np.uint8)
+
+    # lane lines in bird's-eye space, projected through the inverse warp
+    warper = WarpMachine()
+    ys = np.linspace(0, REF_H, 24)
+    curvature = rng.uniform(-60, 60)
+    thickness = max(int(round(12 * sx)), 1)
+    for base, color, dashed in (
+        (WarpMachine.dst_l, (230, 200, 40), False),
+        (WarpMachine.dst_r, (235, 235, 235), True),
+    ):
+        xs = lane_curve(ys, base, curvature, REF_H)
+        pts = np.float32(np.column_stack((xs, ys))).reshape(-1, 1, 2)
+        pts = cv2.perspectiveTransform(pts, warper.Minv).reshape(-1, 2)
+        pts = np.int32(np.round(pts * (sx, sy)))
+        for i in range(len(pts) - 1):
+            if dashed and i % 3 == 2:
+                continue
+            cv2.line(image, tuple(pts[i]), tuple(pts[i + 1]), color, thickness)
+
+    # clutter on the road
+    n_clutter = int(density * 40)
+    for _ in range(n_clutter):
+        x0, x1 = rng.integers(0, w, size=2)
+        y0, y1 = rng.integers(horizon, h, size=2)
+        shade = int(rng.integers(20, 200))
+        cv2.line(image, (int(x0), int(y0)), (int(x1), int(y1)), (shade,) * 3, 2)
+
+    return image
+
+
+def synthetic_birdseye(w, h, density, seed=0):
+    """Deterministic bird's-eye 0/1 edge binary with two lane lines and noise."""
+    rng = np.random.default_rng(seed)
+    binary = np.zeros((h, w), np.uint8)
+
+    ys = np.linspace(0, h, 24)
+    curvature = rng.uniform(-60, 60) * w / REF_W
+    thickness = max(int(round(16 * w / REF_W)), 1)
+    for base in (0.25 * w, 0.75 * w):
+        xs = lane_curve(ys, base, curvature, h)
+        pts = np.int32(np.round(np.column_stack((xs, ys))))
+        cv2.polylines(binary, [pts], False, 1, thickness)
+
+    noise = rng.random((h, w)) < 0.002 * density
+    binary[noise] = 1
+    return binary
+
+
+class Benchmark(object):
+    """
+    Times the pipeline stages with one Profiler per (case, stage), repeating
+    each measurement after a few warmup runs.
+    """
+
+    def __init__(self, repeat=20, warmup=3, camera=None):
+        self.repeat = repeat
+        self.warmup = warmup
+        self.camera = camera or GetCalibratedCamera()
+        self.warper = WarpMachine()
+        self.edge_detector = EdgeDetector(vis_level=VisLevel.NONE)
+        self.profilers = []
+
+    def time(self, case, stage, func, inputs):
+        """Runs func on the inputs (cycling) warmup + repeat times."""
+        for i in range(self.warmup):
+            func(inputs[i % len(inputs)])
+
+        profiler = Profiler("%s/%s" % (case, stage))
+        for i in range(self.repeat):
+            item = inputs[i % len(inputs)]
+            profiler.start()
+            func(item)
+            profiler.update()
+
+        self.profilers.append(profiler)
+        profiler.display_stats()
+
+    def run_case(self, case, frames, birdseyes=None):
+        """
+        Benchmarks every stage on frames. The fitting stages use the given
+        bird's-eye binaries if any, else the warped edges of the frames.
+        """
+        h, w = frames[0].shape[:2]
+        camera = self.camera
+        warper = self.warper
+        detector = self.edge_detector
+
+        undistorted = [camera.undistort(frame) for frame in frames]
+        edges = [detector.detect(image).copy() for image in undistorted]
+        warped = [warper.warp(binary) for binary in edges]
+        binaries = birdseyes if birdseyes is not None else warped
+
+        def fitted(binary):
+            lane_fitting = LaneFit(w, h, vis_level=VisLevel.NONE)
+            lane_fitting.fit_polynomial(binary)
+            return lane_fitting
+
+        def overlay(item):
+            lane_fitting, image = item
+            draw_overlay(warper, lane_fitting, image)
+
+        self.time(case, "undistort", camera.undistort, frames)
+        self.time(case, "detect", detector.detect, undistorted)
+        self.time(case, "warp", warper.warp, edges)
+        self.time(case, "warp_points", warper.warp_points, edges)
+        self.time(
+            case,
+            "find_lane_pixels",
+            LaneFit(w, h, vis_level=VisLevel.NONE).find_lane_pixels,
+            binaries,
+        )
+        self.time(case, "fit_polynomial", fitted, binaries)
+
+        overlay_inputs = [
+            (fitted(binary), image) for binary, image in zip(binaries, undistorted)
+        ]
+        self.time(case, "overlay", overlay, overlay_inputs)
+
+        # the warp is defined for the reference geometry only
+        if h == REF_H:
+            tracker = LaneLinesTracker(tracking=False, camera=camera)
+            self.time(case, "end_to_end", tracker.process_image, frames)
+
+    def run_synthetic(self, resolutions=RESOLUTIONS, densities=DENSITIES, n_frames=4):
+        for w, h in resolutions:
+            for density_name, density in sorted(densities.items()):
+                case = "synthetic_%dx%d_%s" % (w, h, density_name)
+                Log.subsection("Benchmarking %s ..." % case)
+                frames = [
+                    synthetic_frame(w, h, density, seed) for seed in range(n_frames)
+                ]
+                birdseyes = [
+                    synthetic_birdseye(w, h, density, seed) for seed in range(n_frames)
+                ]
+                self.run_case(case, frames, birdseyes)
+
+    def run_test_images(self, images="test_images"):
+        fnames = list_images(images)
+        if not fnames:
+            Log.warn("No test images in %s" % images)
+            return
+        Log.subsection("Benchmarking %d test images ..." % len(fnames))
+        frames = [
+            cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2RGB) for fname in fnames
+        ]
+        self.run_case("test_images", frames)
+
+    def get_results(self):
+        return dict((p.name, p.get_stats()) for p in self.profilers)
+
+    def get_meta(self):
+        return dict(
+            platform=platform.platform(),
+            processor=platform.processor(),
+            cpu_count=os.cpu_count(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            opencv=cv2.__version__,
+            opencv_threads=cv2.getNumThreads(),
+            repeat=self.repeat,
+        )
+
+    def save(self, fname):
+        Log.info("Saving benchmark baseline to %s" % fname)
+        dirname = os.path.dirname(fname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(fname, "w") as f:
+            json.dump(
+                dict(meta=self.get_meta(), results=self.get_results()), f, indent=2
+            )
+
+
+def compare(results, baseline, tolerance):
+    """Returns the (name, baseline ms, current ms) of the regressed stages."""
+    regressions = []
+    for name, stats in sorted(results.items()):
+        base = baseline["results"].get(name)
+        if base is None or "p50_ms" not in base or "p50_ms" not in stats:
+            Log.warn("%s: no baseline" % name)
+            continue
+        ratio = stats["p50_ms"] / base["p50_ms"]
+        line = "%s:  %7.2f -> %7.2f ms (x%.2f)" % (
+            name.ljust(45),
+            base["p50_ms"],
+            stats["p50_ms"],
+            ratio,
+        )
+        if ratio > 1 + tolerance:
+            Log.warn(line + "  REGRESSION")
+            regressions.append((name, base["p50_ms"], stats["p50_ms"]))
+        else:
+            Log.info(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages")
+    parser.add_argument("--save", help="write the results as a baseline (JSON)")
+    parser.add_argument("--baseline", help="baseline to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--images", default="test_images")
+    parser.add_argument("--no-synthetic", action="store_true")
+    args = parser.parse_args()
+
+    Log.section("Benchmarks")
+    benchmark = Benchmark(repeat=args.repeat)
+    if not args.no_synthetic:
+        benchmark.run_synthetic()
+    if args.images:
+        benchmark.run_test_images(args.images)
+
+    if args.save:
+        benchmark.save(args.save)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"] != benchmark.get_meta():
+            Log.warn("Baseline recorded on a different machine or setup")
+
+        Log.subsection("Comparing with %s ..." % args.baseline)
+        regressions = compare(benchmark.get_results(), baseline, args.tolerance)
+        if regressions:
+            Log.warn(
+                "%d stage(s) regressed by more than %d%%"
+                % (len(regressions), 100 * args.tolerance)
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,151 @@
-import pickle
 import os
+import re
+import json
+import tempfile
+import numpy as np
 
 from .logger import Log
 from .save import chmod_rw_all
 
 
 class Cache:
-    def __init__(self, fname):
-        self.fname = "pickle/" + fname
+    """
+    Versioned artifact store in a directory.
 
-    def exists(self):
-        return os.path.isfile(self.fname)
+    NumPy arrays are stored as .npy files and memory-mapped read-only on load,
+    so processes loading the same artifact share its pages. Small metadata is
+    stored as JSON. Every file name carries the schema version, so artifacts of
+    other versions are never loaded. Writes go to a temporary file which is then
+    renamed, and the least recently used entries are evicted when the store
+    grows over max_bytes.
 
-    def save(self, data):
-        Log.subsection("Saving data to pickle file: %s" % self.fname)
-        pickle.dump(data, open(self.fname, "w+b"))
-        chmod_rw_all(self.fname)
+    An entry is a single file, or with entry_sep all the files whose keys share
+    the prefix before entry_sep: artifacts that are only valid together are
+    evicted together.
+    """
 
-    def load(self):
-        Log.subsection("Loading data from pickle file: %s" % self.fname)
-        data = pickle.load(open(self.fname, "r+b"))
-        return data
+    root = "pickle"
+
+    # key and version of a store file name
+    file_pattern = re.compile(r"^(.*)\.v(\d+)\.(npy|json)$")
+
+    def __init__(self, name, version=1, max_bytes=1 << 30, entry_sep=None):
+        self.dir = os.path.join(self.root, name)
+        self.version = version
+        self.max_bytes = max_bytes
+        self.entry_sep = entry_sep
+        os.makedirs(self.dir, exist_ok=True)
+
+        # store size, scanned on the first write and then kept up to date
+        self.size_estimate = None
+
+    def path(self, key, ext):
+        return os.path.join(self.dir, "%s.v%d%s" % (key, self.version, ext))
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key, ".npy")) or os.path.isfile(
+            self.path(key, ".json")
+        )
+
+    def put_array(self, key, array):
+        Log.debug("Saving array to cache: %s" % key)
+        self.write_atomic(self.path(key, ".npy"), lambda f: np.save(f, array))
+
+    def get_array(self, key):
+        """Returns a read-only memory map of the array, or None."""
+        fname = self.path(key, ".npy")
+        if not os.path.isfile(fname):
+            return None
+        Log.debug("Loading array from cache: %s" % key)
+        self.touch(fname)
+        return np.load(fname, mmap_mode="r")
+
+    def put_meta(self, key, data):
+        Log.debug("Saving metadata to cache: %s" % key)
+        self.write_atomic(
+            self.path(key, ".json"), lambda f: f.write(json.dumps(data).encode())
+        )
+
+    def get_meta(self, key):
+        fname = self.path(key, ".json")
+        if not os.path.isfile(fname):
+            return None
+        Log.debug("Loading metadata from cache: %s" % key)
+        self.touch(fname)
+        with open(fname, "rb") as f:
+            return json.loads(f.read().decode())
+
+    def write_atomic(self, fname, write):
+        fd, tmp_name = tempfile.mkstemp(dir=self.dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            chmod_rw_all(tmp_name)
+            size = os.path.getsize(tmp_name)
+            os.replace(tmp_name, fname)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+
+        # only scan the directory when the store may be over budget
+        if self.size_estimate is None:
+            self.size_estimate = self.evict(keep=fname)
+        else:
+            self.size_estimate += size
+            if self.size_estimate > self.max_bytes:
+                self.size_estimate = self.evict(keep=fname)
+
+    def touch(self, fname):
+        """Marks a file as recently used, for LRU eviction."""
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+    def get_entry(self, name):
+        """Entry of a store file name, files of other versions are separate entries."""
+        match = self.file_pattern.match(name)
+        if match is None or self.entry_sep is None:
+            return name
+        key, version = match.group(1), match.group(2)
+        return "%s.v%s" % (key.split(self.entry_sep, 1)[0], version)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until under max_bytes, returns the
+        size. The entry of keep is never removed.
+        """
+        keep_entry = None
+        if keep is not None:
+            keep_entry = self.get_entry(os.path.basename(keep))
+
+        # entry: [last use, size, files]
+        entries = dict()
+        for name in os.listdir(self.dir):
+            fname = os.path.join(self.dir, name)
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entry = entries.setdefault(self.get_entry(name), [0, 0, []])
+            entry[0] = max(entry[0], st.st_mtime)
+            entry[1] += st.st_size
+            entry[2].append(fname)
+
+        total = sum(size for _, size, _ in entries.values())
+
+        # least recently used first
+        candidates = [v for k, v in entries.items() if k != keep_entry]
+        for _, size, fnames in sorted(candidates):
+            if total <= self.max_bytes:
+                break
+            for fname in fnames:
+                Log.info("Evicting cache file: %s" % fname)
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+            total -= size
+        return total
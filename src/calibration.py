@@ -1,6 +1,8 @@
 import os
 import math
 import glob
+import hashlib
+import multiprocessing
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
@@ -10,6 +12,41 @@ from .cache import Cache
 from .save import save_image
 
 
+def find_chessboard_corners(fname, nx, ny, search_size=640):
+    """
+    Searches the chessboard on a copy downscaled to search_size pixels (longest
+    side) and refines the corners with cornerSubPix at full resolution. Falls back
+    to a full resolution search when the board is not found on the small copy.
+
+    Returns the corners or None.
+    """
+    img = cv2.imread(fname)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    corners = None
+    scale = search_size / max(gray.shape)
+    if scale < 1:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ret, small_corners = cv2.findChessboardCorners(small, (nx, ny), None)
+        if ret:
+            corners = small_corners / scale
+
+    if corners is None:
+        ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+        if not ret:
+            return None
+
+    # sub-pixel refinement, the window covers the downscaling error
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    corners = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+    return corners
+
+
+def _init_calibration_worker():
+    # parallelism comes from the pool, avoid oversubscribing cores
+    cv2.setNumThreads(1)
+
+
 class CameraModel:
     """Computes objpoints,imgpoints pair based on chessboard images for calibration"""
 
@@ -18,11 +55,8 @@ class CameraModel:
     imgpoints = []  # 2d points in image plane.
     images = []  # images from which these points where computed.
 
-    # Calibration
-    cal_w = None
-    cal_h = None
-    mtx = None
-    dist = None
+    # bump when the cached data changes meaning, e.g. corner refinement
+    cache_version = 2
 
     def __init__(self):
         self.nx = 9
@@ -30,59 +64,123 @@ class CameraModel:
         self.target_images = glob.glob("camera_cal/calibration*.jpg")
 
         # cache
-        self.cache = Cache("calibration.p")
+        # artifacts of one set of images (points, solutions, maps) are one entry
+        self.cache = Cache("calibration", version=self.cache_version, entry_sep="_")
+        self.cache_key = None
+
+        # (mtx, dist) and remap tables, keyed by resolution
+        self.solutions = dict()
+        self.undistort_maps = dict()
+        self.warp_maps = dict()
+
+    def get_cache_key(self):
+        """
+        Hash of the board parameters and the name, size and modification time of
+        each calibration image: cheap enough for every pool worker start, and
+        any replaced or edited image changes it.
+        """
+        sha = hashlib.sha1()
+        sha.update(("v%d:%d,%d" % (self.cache_version, self.nx, self.ny)).encode())
+        for fname in sorted(self.target_images):
+            st = os.stat(fname)
+            name = os.path.basename(fname)
+            sha.update(("%s:%d:%d" % (name, st.st_size, st.st_mtime_ns)).encode())
+        return sha.hexdigest()
+
+    def artifact(self, name):
+        """Cache key of an artifact derived from the current calibration images."""
+        return "%s_%s" % (self.cache_key[:16], name)
 
     def save(self):
+        n_points = self.nx * self.ny
+        objpoints = np.array(self.objpoints, np.float32).reshape(-1, n_points, 3)
+        imgpoints = np.array(self.imgpoints, np.float32).reshape(-1, n_points, 1, 2)
+        self.cache.put_array(self.artifact("objpoints"), objpoints)
+        self.cache.put_array(self.artifact("imgpoints"), imgpoints)
+        self.save_meta()
+
+    def save_meta(self):
+        solutions = dict()
+        for (w, h), (mtx, dist) in self.solutions.items():
+            solutions["%dx%d" % (w, h)] = dict(mtx=mtx.tolist(), dist=dist.tolist())
+
         data = dict()
-        data["objpoints"] = self.objpoints
-        data["imgpoints"] = self.imgpoints
         data["images"] = self.images
-        self.cache.save(data)
+        data["solutions"] = solutions
+        self.cache.put_meta(self.artifact("calibration"), data)
 
     def load(self):
-        if self.cache.exists():
-            data = self.cache.load()
-            self.objpoints = data["objpoints"]
-            self.imgpoints = data["imgpoints"]
-            self.images = data["images"]
-            return True
-        return False
-
-    def calibrate(self):
+        data = self.cache.get_meta(self.artifact("calibration"))
+        objpoints = self.cache.get_array(self.artifact("objpoints"))
+        imgpoints = self.cache.get_array(self.artifact("imgpoints"))
+        # a partially removed entry is a miss, calibration runs again
+        if data is None or objpoints is None or imgpoints is None:
+            return False
+        Log.subsection("Loading calibration data from: %s" % self.cache.dir)
+        self.images = data["images"]
+        self.objpoints = list(np.array(objpoints))
+        self.imgpoints = list(np.array(imgpoints))
+
+        self.solutions = dict()
+        for size, solution in data["solutions"].items():
+            w, h = [int(v) for v in size.split("x")]
+            mtx = np.array(solution["mtx"])
+            dist = np.array(solution["dist"])
+            self.solutions[(w, h)] = (mtx, dist)
+        return True
+
+    def load_maps(self, name):
+        """Memory-maps cached remap tables, shared by all processes loading them."""
+        map1 = self.cache.get_array(self.artifact(name + "_map1"))
+        map2 = self.cache.get_array(self.artifact(name + "_map2"))
+        if map1 is None or map2 is None:
+            return None
+        return map1, map2
+
+    def save_maps(self, name, maps):
+        self.cache.put_array(self.artifact(name + "_map1"), maps[0])
+        self.cache.put_array(self.artifact(name + "_map2"), maps[1])
+
+    def calibrate(self, workers=None):
+        self.cache_key = self.get_cache_key()
         if self.load():
             Log.subsection("Using cached calibration data ...")
             return
-        Log.subsection("Running calibration on %d images ..." % len(self.target_images))
+        workers = workers or multiprocessing.cpu_count()
+        Log.subsection(
+            "Running calibration on %d images (%d workers) ..."
+            % (len(self.target_images), workers)
+        )
 
         # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
         objp = np.zeros((self.nx * self.ny, 3), np.float32)
         objp[:, :2] = np.mgrid[0 : self.nx, 0 : self.ny].T.reshape(-1, 2)
 
-        # Step through the list and search for chessboard corners
-        for fname in self.target_images:
-            self.calibrate_single(fname, objp)
+        # Search for chessboard corners on all images
+        tasks = [(fname, self.nx, self.ny) for fname in self.target_images]
+        if workers > 1:
+            with multiprocessing.Pool(workers, _init_calibration_worker) as pool:
+                found = pool.starmap(find_chessboard_corners, tasks)
+        else:
+            found = [find_chessboard_corners(*task) for task in tasks]
+
+        self.images = []
+        self.objpoints = []
+        self.imgpoints = []
+        for fname, corners in zip(self.target_images, found):
+            Log.info("file: " + fname)
+            if corners is not None:
+                self.images.append(fname)
+                self.objpoints.append(objp)
+                self.imgpoints.append(corners)
+            else:
+                Log.warn(
+                    "cv2.findChessboardCorners was not able to process file: %s" % fname
+                )
 
         # Update cache
         self.save()
 
-    def calibrate_single(self, fname, objp):
-        Log.info("file: " + fname)
-        img = cv2.imread(fname)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Find the chessboard corners
-        ret, corners = cv2.findChessboardCorners(gray, (self.nx, self.ny), None)
-
-        # If found, save object points, image points
-        if ret == True:
-            self.images.append(fname)
-            self.objpoints.append(objp)
-            self.imgpoints.append(corners)
-        else:
-            Log.warn(
-                "cv2.findChessboardCorners was not able to process file: %s" % fname
-            )
-
     def display_calibration(self):
         n_images = len(self.images)
         n_columns = 4
@@ -125,30 +223,132 @@ class CameraModel:
 
     def get_calibration(self, w, h):
         # Use cached
-        if w == self.cal_w and h == self.cal_h:
-            return self.mtx, self.dist
+        key = (w, h)
+        if key in self.solutions:
+            return self.solutions[key]
         Log.info(
             "Computing camera matrix and distortion coefficients for (w,h)=(%d,%d)"
             % (w, h)
         )
 
         # Compute
-        [_, self.mtx, self.dist, _, _] = cv2.calibrateCamera(
+        [_, mtx, dist, _, _] = cv2.calibrateCamera(
             self.objpoints, self.imgpoints, (w, h), None, None
         )
-
-        self.cal_w = w
-        self.cal_h = h
-
-        return self.mtx, self.dist
-
-    def undistort(self, img):
+        self.solutions[key] = (mtx, dist)
+        self.save_meta()
+
+        return mtx, dist
+
+    def get_scaled_camera(self, mtx, w, h, scale):
+        """Camera matrix and size of the output images downscaled by scale."""
+        if scale == 1:
+            return mtx, (w, h)
+        scaled_mtx = mtx.copy()
+        scaled_mtx[:2] *= scale
+        return scaled_mtx, (int(round(w * scale)), int(round(h * scale)))
+
+    def get_input_camera(self, mtx, scale):
+        """Camera matrix of the raw images downscaled by scale (INTER_AREA)."""
+        if scale == 1:
+            return mtx
+        input_mtx = mtx.copy()
+        input_mtx[:2, :2] *= scale
+        # pixel centers of the downscaled image
+        input_mtx[:2, 2] = (mtx[:2, 2] + 0.5) * scale - 0.5
+        return input_mtx
+
+    def downscale(self, img, scale):
+        """Area-averaged downscaling of raw images, the input of scaled maps."""
+        if scale == 1:
+            return img
+        h, w = img.shape[:2]
+        size = (int(round(w * scale)), int(round(h * scale)))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    def get_undistort_maps(self, w, h, scale=1.0):
+        """
+        Returns fixed-point remap tables for distortion correction at (w,h). With
+        scale < 1 the tables read the raw image downscaled by scale (see
+        downscale) and write the downscaled undistorted image.
+        """
+        key = (w, h, scale)
+        if key in self.undistort_maps:
+            return self.undistort_maps[key]
+
+        name = "undistort_%dx%d" % (w, h)
+        if scale != 1:
+            name += "_area_x%g" % scale
+        maps = self.load_maps(name)
+        if maps is None:
+            [mtx, dist] = self.get_calibration(w, h)
+            Log.info("Computing undistortion maps for (w,h)=(%d,%d)" % (w, h))
+            new_mtx, size = self.get_scaled_camera(mtx, w, h, scale)
+            input_mtx = self.get_input_camera(mtx, scale)
+            maps = cv2.initUndistortRectifyMap(
+                input_mtx, dist, None, new_mtx, size, cv2.CV_16SC2
+            )
+            self.save_maps(name, maps)
+        self.undistort_maps[key] = maps
+        return maps
+
+    def get_warp_maps(self, w, h, M, scale=1.0):
+        """
+        Returns fixed-point remap tables for the undistort -> perspective warp
+        composition at (w,h), where M is the perspective transform defined on
+        undistorted pixel coordinates. With scale < 1 the tables read the raw
+        image downscaled by scale (see downscale) and write the downscaled
+        warped image.
+
+        The homography is expressed as a rectification transform on normalized
+        coordinates: R = K^-1 * M * K.
+        """
+        key = (w, h, M.tobytes(), scale)
+        if key in self.warp_maps:
+            return self.warp_maps[key]
+
+        M_hash = hashlib.sha1(np.float64(M).tobytes()).hexdigest()[:12]
+        name = "warp_%dx%d_%s" % (w, h, M_hash)
+        if scale != 1:
+            name += "_area_x%g" % scale
+        maps = self.load_maps(name)
+        if maps is None:
+            [mtx, dist] = self.get_calibration(w, h)
+            Log.info("Computing undistort+warp maps for (w,h)=(%d,%d)" % (w, h))
+            R = np.linalg.inv(mtx).dot(M).dot(mtx)
+            new_mtx, size = self.get_scaled_camera(mtx, w, h, scale)
+            input_mtx = self.get_input_camera(mtx, scale)
+            maps = cv2.initUndistortRectifyMap(
+                input_mtx, dist, R, new_mtx, size, cv2.CV_16SC2
+            )
+            self.save_maps(name, maps)
+        self.warp_maps[key] = maps
+        return maps
+
+    def undistort(self, img, scale=1.0):
+        """
+        Distortion correction. With scale < 1 the image is area-averaged to the
+        output scale first, so that the remap does not alias.
+        """
         w = img.shape[1]
         h = img.shape[0]
-        [mtx, dist] = self.get_calibration(w, h)
-        undistorted = cv2.undistort(img, mtx, dist, None, mtx)
+        [map1, map2] = self.get_undistort_maps(w, h, scale)
+        undistorted = cv2.remap(
+            self.downscale(img, scale), map1, map2, cv2.INTER_LINEAR
+        )
         return undistorted
 
+    def undistort_warp(self, img, M, scale=1.0):
+        """
+        Distortion correction and perspective transform in a single remap, after
+        the same area-averaged downscaling as undistort with scale < 1.
+        """
+        w = img.shape[1]
+        h = img.shape[0]
+        [map1, map2] = self.get_warp_maps(w, h, M, scale)
+        warped = cv2.remap(self.downscale(img, scale), map1, map2, cv2.INTER_LINEAR)
+        return warped
+
 
 def GetCalibratedCamera():
     camera = CameraModel()
@@ -166,7 +366,7 @@ class WarpMachine:
     dst_l = 320
     dst_r = 960
 
-    def __init__(self):
+    def __init__(self, scale=1.0):
         h = self.h
         l = self.left
         r = self.right
@@ -176,15 +376,95 @@ class WarpMachine:
         dl = self.dst_l
         dr = self.dst_r
 
-        self.src = np.float32([[l, h], [tl, t], [tr, t], [r, h]])
-        self.dst = np.float32([[dl, h], [dl, 0], [dr, 0], [dr, h]])
+        # points are given for 1280x720 images, scale applies to both sides
+        self.scale = scale
+        self.src = np.float32([[l, h], [tl, t], [tr, t], [r, h]]) * scale
+        self.dst = np.float32([[dl, h], [dl, 0], [dr, 0], [dr, h]]) * scale
         self.M = cv2.getPerspectiveTransform(self.src, self.dst)
         self.Minv = cv2.getPerspectiveTransform(self.dst, self.src)
 
+    def get_roi(self, w, h, halo=0):
+        """
+        Returns the (x0, y0, x1, y1) bounding box of the src trapezoid grown by
+        halo pixels and clipped to a (w,h) image.
+        """
+        x0 = max(int(np.floor(np.min(self.src[:, 0]))) - halo, 0)
+        y0 = max(int(np.floor(np.min(self.src[:, 1]))) - halo, 0)
+        x1 = min(int(np.ceil(np.max(self.src[:, 0]))) + halo, w)
+        y1 = min(int(np.ceil(np.max(self.src[:, 1]))) + halo, h)
+        return x0, y0, x1, y1
+
     def warp(self, image):
         img_size = (image.shape[1], image.shape[0])
         return cv2.warpPerspective(image, self.M, img_size, flags=cv2.INTER_LINEAR)
 
+    def get_canvas_roi(self, w, h):
+        """
+        Returns the (x0, y0, x1, y1) bounding box of the pixels of a (w,h) image
+        that warp into the (w,h) bird's-eye image.
+        """
+        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+        pts = cv2.perspectiveTransform(corners, self.Minv).reshape(-1, 2)
+        x0 = max(int(np.floor(np.min(pts[:, 0]))), 0)
+        y0 = max(int(np.floor(np.min(pts[:, 1]))), 0)
+        x1 = min(int(np.ceil(np.max(pts[:, 0]))) + 1, w)
+        y1 = min(int(np.ceil(np.max(pts[:, 1]))) + 1, h)
+        return x0, y0, x1, y1
+
+    def warp_points(self, binary):
+        """
+        Returns the bird's-eye (x, y) pixel coordinates of the nonzero pixels of
+        binary, mapped through M instead of resampling the whole image, with the
+        bird's-eye area and column width of each pixel (far pixels are stretched
+        over several bird's-eye pixels, near ones are shrunk). Points outside
+        the bird's-eye image (binary size) are dropped and y is sorted, as with
+        nonzero().
+        """
+        h, w = binary.shape[:2]
+        x0, y0, x1, y1 = self.get_canvas_roi(w, h)
+        pts = cv2.findNonZero(binary[y0:y1, x0:x1])
+        if pts is None:
+            empty = np.empty(0)
+            return empty.astype(np.intp), empty.astype(np.intp), empty, empty
+
+        pts = pts.reshape(-1, 2)
+        px = pts[:, 0] + float(x0)
+        py = pts[:, 1] + float(y0)
+
+        # homogeneous coordinates, points beyond the horizon have a z of the
+        # opposite sign to the road (src points)
+        M = self.M
+        z = M[2, 0] * px + M[2, 1] * py + M[2, 2]
+        road_z = M[2, 0] * self.src[0, 0] + M[2, 1] * self.src[0, 1] + M[2, 2]
+        front = z * road_z > 0
+        if not np.all(front):
+            px, py, z = px[front], py[front], z[front]
+
+        u = (M[0, 0] * px + M[0, 1] * py + M[0, 2]) / z
+        x = np.floor(u + 0.5).astype(np.intp)
+        y = np.floor((M[1, 0] * px + M[1, 1] * py + M[1, 2]) / z + 0.5).astype(np.intp)
+        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        x = x[inside]
+        y = y[inside]
+        u = u[inside]
+        z = z[inside]
+
+        # Jacobian determinant of the projective map, and the columns covered
+        # by the (sheared) footprint of a pixel: |du/dx| + |du/dy|
+        area = np.abs(np.linalg.det(M) / (z * z * z))
+        width = np.abs(M[0, 0] - u * M[2, 0]) + np.abs(M[0, 1] - u * M[2, 1])
+        width /= np.abs(z)
+
+        # image rows map to bird's-eye rows for the default src/dst points,
+        # so the row-major scan order is usually kept
+        if np.any(y[1:] < y[:-1]):
+            order = np.argsort(y, kind="stable")
+            x = x[order]
+            y = y[order]
+            area = area[order]
+            width = width[order]
+        return x, y, area, width
+
     def unwarp(self, image):
         img_size = (image.shape[1], image.shape[0])
         return cv2.warpPerspective(image, self.Minv, img_size, flags=cv2.INTER_LINEAR)
@@ -5,28 +5,27 @@ import matplotlib.pyplot as plt
 
 from .logger import Log
 from .save import save_image
+from .visualization import VisLevel
 
 
 class Transform(object):
-    def to_binary(image, threshold):
-        binary = np.zeros_like(image)
-        binary[(image >= threshold[0]) & (image <= threshold[1])] = 1
-        return binary
-
-    def to_8_bits(image):
-        img_abs = np.absolute(image)
-        scaled = np.uint8(255 * img_abs / np.max(img_abs))
-        return scaled
-
-    def binary_and(binary_1, binary_2):
-        binary = np.zeros_like(binary_1)
-        binary[(binary_1 == 1) & (binary_2 == 1)] = 1
-        return binary
-
-    def binary_or(binary_1, binary_2):
-        binary = np.zeros_like(binary_1)
-        binary[(binary_1 == 1) | (binary_2 == 1)] = 1
-        return binary
+    def to_binary(image, threshold, out=None):
+        """uint8 binary (0/1) of threshold[0] <= image <= threshold[1]"""
+        out = cv2.inRange(image, threshold[0], threshold[1], dst=out)
+        np.bitwise_and(out, 1, out=out)
+        return out
+
+    def to_8_bits(image, out=None):
+        min_value, max_value, _, _ = cv2.minMaxLoc(image)
+        max_abs = max(max_value, -min_value)
+        alpha = 255.0 / max_abs if max_abs > 0 else 0.0
+        return cv2.convertScaleAbs(image, dst=out, alpha=alpha)
+
+    def binary_and(binary_1, binary_2, out=None):
+        return cv2.bitwise_and(binary_1, binary_2, dst=out)
+
+    def binary_or(binary_1, binary_2, out=None):
+        return cv2.bitwise_or(binary_1, binary_2, dst=out)
 
     def deg_to_rad(theta_deg, delta_deg):
         theta = theta_deg * np.pi / 180.0
@@ -34,15 +33,67 @@ class Transform(object):
         return (theta - delta, theta + delta)
 
 
+class EdgeWorkspace(object):
+    """Preallocated float32/uint8 buffers for edge detection at a fixed shape."""
+
+    def __init__(self, shape):
+        h, w = shape[:2]
+        self.shape = (h, w)
+
+        # color
+        self.gray = np.empty((h, w), np.uint8)
+        self.hls = np.empty((h, w, 3), np.uint8)
+        self.s_channel = np.empty((h, w), np.uint8)
+
+        # sobel
+        self.sobel_x = np.empty((h, w), np.float32)
+        self.sobel_y = np.empty((h, w), np.float32)
+        self.sobel_mag = np.empty((h, w), np.float32)
+        self.sobel_dir = np.empty((h, w), np.float32)
+        self.abs_x = np.empty((h, w), np.float32)
+        self.abs_y = np.empty((h, w), np.float32)
+        self.sx_scaled = np.empty((h, w), np.uint8)
+        self.sy_scaled = np.empty((h, w), np.uint8)
+        self.smag_scaled = np.empty((h, w), np.uint8)
+
+        # binaries
+        self.s_binary = np.empty((h, w), np.uint8)
+        self.sx_binary = np.empty((h, w), np.uint8)
+        self.sy_binary = np.empty((h, w), np.uint8)
+        self.smag_binary = np.empty((h, w), np.uint8)
+        self.sdir_binary = np.empty((h, w), np.uint8)
+        self.sobel_xy_binary = np.empty((h, w), np.uint8)
+        self.sobel_md_binary = np.empty((h, w), np.uint8)
+        self.sobel_all_binary = np.empty((h, w), np.uint8)
+        self.result = np.empty((h, w), np.uint8)
+
+    def fits(self, shape):
+        return self.shape == tuple(shape[:2])
+
+
+class NoWorkspace(object):
+    """
+    Stands in for an EdgeWorkspace when the filters are used on their own: every
+    buffer is None, so cv2/numpy allocate only the outputs actually computed.
+    """
+
+    def __getattr__(self, name):
+        return None
+
+
+NO_WORKSPACE = NoWorkspace()
+
+
 class HLSFilter:
     def __init__(self):
         pass
 
-    def filter_s(self, image, threshold=(150, 255)):
+    def filter_s(self, image, threshold=(150, 255), ws=None):
         """Convert to HLS color space and separate the S channel"""
-        hls = cv2.cvtColor(image, cv2.COLOR_RGB2HLS)
-        s_channel = hls[:, :, 2]
-        s_binary = Transform.to_binary(s_channel, threshold)
+        ws = ws or NO_WORKSPACE
+        hls = cv2.cvtColor(image, cv2.COLOR_RGB2HLS, dst=ws.hls)
+        s_channel = cv2.extractChannel(hls, 2, dst=ws.s_channel)
+        s_binary = Transform.to_binary(s_channel, threshold, out=ws.s_binary)
         return s_binary, s_channel
 
 
@@ -50,30 +101,36 @@ class SobelFilter:
     def __init__(self, kernel_size):
         self.kernel_size = kernel_size
 
-    def filter_x(self, gray, threshold=(50, 255)):
-        sobel = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=self.kernel_size)
-        scaled = Transform.to_8_bits(sobel)
-        binary = Transform.to_binary(scaled, threshold)
+    def filter_x(self, gray, threshold=(50, 255), ws=None):
+        ws = ws or NO_WORKSPACE
+        k = self.kernel_size
+        sobel = cv2.Sobel(gray, cv2.CV_32F, 1, 0, dst=ws.sobel_x, ksize=k)
+        scaled = Transform.to_8_bits(sobel, out=ws.sx_scaled)
+        binary = Transform.to_binary(scaled, threshold, out=ws.sx_binary)
         return binary, scaled, sobel
 
-    def filter_y(self, gray, threshold=(50, 255)):
-        sobel = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=self.kernel_size)
-        scaled = Transform.to_8_bits(sobel)
-        binary = Transform.to_binary(scaled, threshold)
+    def filter_y(self, gray, threshold=(50, 255), ws=None):
+        ws = ws or NO_WORKSPACE
+        k = self.kernel_size
+        sobel = cv2.Sobel(gray, cv2.CV_32F, 0, 1, dst=ws.sobel_y, ksize=k)
+        scaled = Transform.to_8_bits(sobel, out=ws.sy_scaled)
+        binary = Transform.to_binary(scaled, threshold, out=ws.sy_binary)
         return binary, scaled, sobel
 
-    def filter_mag(self, sx, sy, threshold=(50, 255)):
-        sobel = np.sqrt(sx ** 2 + sy ** 2)
-        scaled = Transform.to_8_bits(sobel)
-        binary = Transform.to_binary(scaled, threshold)
+    def filter_mag(self, sx, sy, threshold=(50, 255), ws=None):
+        ws = ws or NO_WORKSPACE
+        sobel = cv2.magnitude(sx, sy, ws.sobel_mag)
+        scaled = Transform.to_8_bits(sobel, out=ws.smag_scaled)
+        binary = Transform.to_binary(scaled, threshold, out=ws.smag_binary)
         return binary, scaled, sobel
 
-    def filter_dir(self, sx, sy, threshold=(60, 20)):
+    def filter_dir(self, sx, sy, threshold=(60, 20), ws=None):
+        ws = ws or NO_WORKSPACE
         rad_threshold = Transform.deg_to_rad(threshold[0], threshold[1])
-        absx = np.absolute(sx)
-        absy = np.absolute(sy)
-        sobel = np.arctan2(absy, absx)
-        binary = Transform.to_binary(sobel, rad_threshold)
+        absx = np.absolute(sx, out=ws.abs_x)
+        absy = np.absolute(sy, out=ws.abs_y)
+        sobel = cv2.phase(absx, absy, ws.sobel_dir)
+        binary = Transform.to_binary(sobel, rad_threshold, out=ws.sdir_binary)
         return binary, sobel
 
 
@@ -84,58 +141,140 @@ class EdgeDetector(object):
     s_binary = None
     sobel_all_binary = None
 
-    def __init__(self):
+    # thresholds
+    s_threshold = (150, 255)
+    sx_threshold = (50, 255)
+    sy_threshold = (50, 255)
+    mag_threshold = (50, 255)
+    dir_threshold = (60, 20)
+
+    def __init__(self, vis_level=VisLevel.DEBUG):
         self.sobel = SobelFilter(kernel_size=13)
         self.hls = HLSFilter()
+        self.vis_level = vis_level
+        self.workspace = None
+        self.roi_key = None
+        self.roi_result = None
+
+    def get_config(self):
+        """Parameters that change the detection output."""
+        return dict(
+            kernel_size=self.sobel.kernel_size,
+            s_threshold=self.s_threshold,
+            sx_threshold=self.sx_threshold,
+            sy_threshold=self.sy_threshold,
+            mag_threshold=self.mag_threshold,
+            dir_threshold=self.dir_threshold,
+        )
+
+    def get_workspace(self, shape):
+        """Reuses the frame workspace while the input shape does not change."""
+        if self.workspace is None or not self.workspace.fits(shape):
+            self.workspace = EdgeWorkspace(shape)
+        return self.workspace
 
     def detect(self, image):
+        """
+        Returns the uint8 (0/1) edge binary. The returned array belongs to the
+        detector workspace and is overwritten by the next call.
+        """
+        ws = self.get_workspace(image.shape)
+
         # gray
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=ws.gray)
 
         # HLS
-        s_binary, s_channel = self.hls.filter_s(image)
+        s_binary, s_channel = self.hls.filter_s(image, self.s_threshold, ws=ws)
 
         # Sobel
-        sx_binary, sx_scaled, sobel_x = self.sobel.filter_x(gray)
-        sy_binary, sy_scaled, sobel_y = self.sobel.filter_y(gray)
-        smag_binary, smag_scaled, sobel_mag = self.sobel.filter_mag(sobel_x, sobel_y)
-        sdir_binary, sobel_dir = self.sobel.filter_dir(sobel_x, sobel_y)
+        sx_binary, sx_scaled, sobel_x = self.sobel.filter_x(
+            gray, self.sx_threshold, ws=ws
+        )
+        sy_binary, sy_scaled, sobel_y = self.sobel.filter_y(
+            gray, self.sy_threshold, ws=ws
+        )
+        smag_binary, smag_scaled, sobel_mag = self.sobel.filter_mag(
+            sobel_x, sobel_y, self.mag_threshold, ws=ws
+        )
+        sdir_binary, sobel_dir = self.sobel.filter_dir(
+            sobel_x, sobel_y, self.dir_threshold, ws=ws
+        )
 
         # combined
-        sobel_xy_binary = Transform.binary_and(sx_binary, sy_binary)
-        sobel_md_binary = Transform.binary_and(smag_binary, sdir_binary)
-        sobel_all_binary = Transform.binary_or(sobel_xy_binary, sobel_md_binary)
-        result = Transform.binary_or(sobel_all_binary, s_binary)
+        sobel_xy_binary = Transform.binary_and(
+            sx_binary, sy_binary, out=ws.sobel_xy_binary
+        )
+        sobel_md_binary = Transform.binary_and(
+            smag_binary, sdir_binary, out=ws.sobel_md_binary
+        )
+        sobel_all_binary = Transform.binary_or(
+            sobel_xy_binary, sobel_md_binary, out=ws.sobel_all_binary
+        )
+        result = Transform.binary_or(sobel_all_binary, s_binary, out=ws.result)
 
         # keep results for visualization
-        self.image = image
-        self.s_binary = cv2.cvtColor(s_binary, cv2.COLOR_GRAY2RGB)
-        self.sobel_all_binary = cv2.cvtColor(sobel_all_binary, cv2.COLOR_GRAY2RGB)
-        self.result = cv2.cvtColor(result, cv2.COLOR_GRAY2RGB)
+        # references are valid until the next call, DEBUG keeps copies
+        if self.vis_level >= VisLevel.DEBUG:
+            self.image = image.copy()
+            self.s_binary = s_binary.copy()
+            self.sobel_all_binary = sobel_all_binary.copy()
+            self.result = result.copy()
+        else:
+            self.image = image
+            self.s_binary = s_binary
+            self.sobel_all_binary = sobel_all_binary
+            self.result = result
 
         return result
 
+    def get_halo(self):
+        """Pixels around a ROI needed for the Sobel kernel support."""
+        return self.sobel.kernel_size // 2
+
+    def detect_roi(self, image, roi):
+        """
+        Runs detection only inside roi=(x0, y0, x1, y1) and returns a full-size
+        binary image, zero outside the roi.
+
+        Note: 8 bit scaling of the Sobel outputs is normalized to the roi maximum
+        instead of the full frame maximum.
+        """
+        x0, y0, x1, y1 = roi
+        roi_result = self.detect(image[y0:y1, x0:x1])
+
+        # outside of the roi stays zero, so the full-size buffer is reused
+        key = (image.shape[:2], tuple(roi))
+        if self.roi_key != key:
+            self.roi_key = key
+            self.roi_result = np.zeros(image.shape[:2], dtype=np.uint8)
+        self.roi_result[y0:y1, x0:x1] = roi_result
+        return self.roi_result
+
     def build_result_vis(self):
         """image + s_binary + sobel_all_binary + output"""
 
         # scale binary images
         max_value = np.max(self.image)
-        self.s_binary = self.s_binary * max_value
-        self.sobel_all_binary = self.sobel_all_binary * max_value
-        self.result = self.result * max_value
+
+        def to_rgb(binary):
+            return cv2.cvtColor(binary, cv2.COLOR_GRAY2RGB) * max_value
+
+        s_binary = to_rgb(self.s_binary)
+        sobel_all_binary = to_rgb(self.sobel_all_binary)
+        result = to_rgb(self.result)
 
         def put_text(image, text, color=(0, 0, 255)):
             font = cv2.FONT_HERSHEY_SIMPLEX
             cv2.putText(image, text, (10, 100), font, 3, color, 5, cv2.LINE_AA)
 
         # Put labels
-        put_text(self.result, "Detection")
-        put_text(self.s_binary, "HLS: S Channel Binary")
-        put_text(self.sobel_all_binary, "Sobel Binary")
+        put_text(result, "Detection")
+        put_text(s_binary, "HLS: S Channel Binary")
+        put_text(sobel_all_binary, "Sobel Binary")
 
         # Build 2x2 image grid
-        ca = np.concatenate((self.image, self.result), axis=1)
-        cb = np.concatenate((self.s_binary, self.sobel_all_binary), axis=1)
+        ca = np.concatenate((self.image, result), axis=1)
+        cb = np.concatenate((s_binary, sobel_all_binary), axis=1)
         vis = np.concatenate((ca, cb), axis=0)
 
         return vis
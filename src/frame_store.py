@@ -0,0 +1,135 @@
+"""
+Decoded frame store: a video decoded once into a raw uint8 (N, H, W, 3) RGB frame
+file, memory-mapped on load for zero-copy slicing and O(1) random access.
+
+    python -m src.frame_store project_video.mp4 pickle/project_video.frames
+
+The file starts with a fixed size header holding JSON metadata, followed by the
+frames.
+"""
+
+import json
+import argparse
+
+import numpy as np
+
+from .logger import Log
+from .save import chmod_rw_all
+
+MAGIC = b"LANEFRM1"
+HEADER_SIZE = 4096
+EXTENSION = ".frames"
+
+
+def is_frame_store(fname):
+    return fname.endswith(EXTENSION)
+
+
+def write_header(f, meta):
+    data = MAGIC + json.dumps(meta).encode()
+    if len(data) > HEADER_SIZE:
+        raise ValueError("Frame store header too large")
+    f.seek(0)
+    f.write(data.ljust(HEADER_SIZE, b"\0"))
+
+
+def read_header(f):
+    data = f.read(HEADER_SIZE)
+    if not data.startswith(MAGIC):
+        raise ValueError("Not a frame store file")
+    return json.loads(data[len(MAGIC) :].rstrip(b"\0").decode())
+
+
+def decode_video(input_file, store_file, subclip_seconds=None):
+    """Decodes the video once and writes its frames to store_file."""
+    from .video_io import open_clip
+
+    clip = open_clip(input_file, subclip_seconds)
+    w, h = clip.size
+    meta = dict(fps=clip.fps, width=w, height=h, n_frames=0, source=input_file)
+
+    Log.subsection("Decoding frames to: %s" % store_file)
+    with open(store_file, "wb") as f:
+        write_header(f, meta)
+        for frame in clip.iter_frames(dtype="uint8"):
+            f.write(np.ascontiguousarray(frame).data)
+            meta["n_frames"] += 1
+
+        # frame count is only known at the end
+        write_header(f, meta)
+    chmod_rw_all(store_file)
+    Log.info("%d frames (%dx%d)" % (meta["n_frames"], w, h))
+
+    return FrameStore(store_file)
+
+
+class FrameStore(object):
+    """
+    Read-only, memory-mapped frames. Slicing returns views of the file pages,
+    which are shared by every process mapping the same file.
+
+    Implements the part of the moviepy clip interface used by the tracker
+    (size, fps, duration, iter_frames, subclip).
+    """
+
+    def __init__(self, store_file, start=0, stop=None):
+        self.store_file = store_file
+        with open(store_file, "rb") as f:
+            meta = read_header(f)
+        self.fps = meta["fps"]
+        self.size = (meta["width"], meta["height"])
+
+        all_frames = np.memmap(
+            store_file,
+            dtype=np.uint8,
+            mode="r",
+            offset=HEADER_SIZE,
+            shape=(meta["n_frames"], meta["height"], meta["width"], 3),
+        )
+        self.start, self.stop, _ = slice(start, stop).indices(len(all_frames))
+        self.frames = all_frames[self.start : self.stop]
+
+    @property
+    def duration(self):
+        return len(self.frames) / self.fps
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def iter_frames(self, fps=None, with_times=False, logger=None, dtype=None):
+        """
+        Same arguments as the moviepy clip method: frames sampled at fps (the
+        store fps by default), (t, frame) pairs with with_times, converted to
+        dtype if given. logger is accepted for compatibility, nothing is logged.
+        """
+        fps = fps or self.fps
+        for i in range(int(len(self.frames) * fps / self.fps + 1e-6)):
+            t = i / fps
+            frame = self.frames[min(int(t * self.fps + 1e-6), len(self.frames) - 1)]
+            if dtype is not None and frame.dtype != dtype:
+                frame = frame.astype(dtype)
+            yield (t, frame) if with_times else frame
+
+    def subclip(self, t_start=0, t_end=None):
+        start = self.start + int(round(t_start * self.fps))
+        stop = self.stop if t_end is None else self.start + int(round(t_end * self.fps))
+        return FrameStore(self.store_file, start, min(stop, self.stop))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a video into a frame store")
+    parser.add_argument("input_file")
+    parser.add_argument("store_file")
+    parser.add_argument("--subclip", type=float, default=None)
+    args = parser.parse_args()
+
+    if not is_frame_store(args.store_file):
+        Log.warn("Frame store files should end with %s" % EXTENSION)
+    decode_video(args.input_file, args.store_file, args.subclip)
+
+
+if __name__ == "__main__":
+    main()
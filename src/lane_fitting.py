@@ -2,8 +2,92 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 
+from .visualization import VisLevel
+
+
+def rescale_fit(fit, scale):
+    """
+    Coefficients of the polynomial x = a*y^2 + b*y + c once x and y pixel
+    coordinates are multiplied by scale.
+    """
+    a, b, c = fit
+    return np.array([a / scale, b, c * scale])
+
+
+class EdgePoints(object):
+    """
+    Nonzero pixels of a (width, height) bird's-eye binary as x and y arrays,
+    sorted by y as nonzero() returns them. Lane searches run on these sparse
+    coordinates, e.g. edge pixels warped one by one, see WarpMachine.warp_points.
+
+    weights are the bird's-eye pixels each point stands for (one each if None),
+    so that pixel counts, means and fits match the ones of a warped binary, and
+    spans the bird's-eye columns they cover (their weight is spread over them
+    in the histogram, as a stretched pixel of a warped binary is).
+    """
+
+    def __init__(self, x, y, width, height, weights=None, spans=None):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.weights = weights
+        self.spans = spans
+
+    def get_weights(self, inds, start=0):
+        if self.weights is None:
+            return None
+        return self.weights[start : start + len(inds)][inds]
+
+    def count(self, inds, start=0):
+        """Pixels of the points selected by the boolean inds, from point start."""
+        if self.weights is None:
+            return np.count_nonzero(inds)
+        return np.sum(self.get_weights(inds, start))
+
+    def mean_x(self, inds, start=0):
+        x = self.x[start : start + len(inds)][inds]
+        return np.average(x, weights=self.get_weights(inds, start))
+
+    def get_histogram(self, start=0):
+        """Pixels per column of the points from point start."""
+        x = self.x[start:]
+        if self.weights is None:
+            return np.bincount(x, minlength=self.width)
+
+        # each point adds weight / span to the columns [low, high) it covers
+        half = self.spans[start:] / 2
+        low = np.floor(x + 0.5 - half).astype(np.intp)
+        high = np.maximum(np.floor(x + 0.5 + half).astype(np.intp), low + 1)
+        values = self.weights[start:] / (high - low)
+        low = np.clip(low, 0, self.width)
+        high = np.clip(high, 0, self.width)
+        steps = np.bincount(low, values, self.width + 1)
+        steps -= np.bincount(high, values, self.width + 1)
+        return np.cumsum(steps[: self.width])
+
+    def to_binary(self):
+        binary = np.zeros((self.height, self.width), dtype=np.uint8)
+        binary[self.y, self.x] = 1
+        return binary
+
+
+def get_edge_points(binary_warped):
+    """EdgePoints of a bird's-eye binary, EdgePoints are returned as is."""
+    if isinstance(binary_warped, EdgePoints):
+        return binary_warped
+    nonzeroy, nonzerox = binary_warped.nonzero()
+    h, w = binary_warped.shape[:2]
+    return EdgePoints(nonzerox, nonzeroy, w, h)
+
 
 class LaneFit(object):
+    """
+    Fits the lane lines of bird's-eye binaries (or their EdgePoints). With
+    scale < 1 the binaries are downscaled by scale: pixels are searched in the
+    binary, but the fits and everything derived from them are in
+    (img_width, img_height) pixels.
+    """
 
     # lane size [m]
     lane_width = 3.7
@@ -14,9 +98,42 @@ class LaneFit(object):
     left_fit = None
     right_fit = None
 
-    def __init__(self, img_width, img_height):
+    # sliding window search: windows, half width and pixels to recenter a window
+    n_windows = 9
+    window_margin = 100
+    min_window_pixels = 50
+
+    # tracking: search around the previous fit
+    search_margin = 100
+    min_track_pixels = 200
+    min_lane_width_px = 450
+    max_lane_width_px = 850
+
+    # prediction: fraction of the last frame to frame change carried over
+    extrapolation = 0.5
+
+    def __init__(
+        self,
+        img_width,
+        img_height,
+        tracking=False,
+        vis_level=VisLevel.DEBUG,
+        scale=1.0,
+    ):
         self.image_width = img_width
         self.image_height = img_height
+        self.vis_level = vis_level
+        self.scale = scale
+        self.base_scale = scale
+
+        # last search, kept to build the debug image on request
+        self.windows = []
+        self.lane_pixels = None
+
+        # keep fits between frames and search around them
+        self.tracking = tracking
+        self.tracked = False
+        self.prev_fits = None
 
         # y pixel where to measure curvature/position
         self.target_px = self.image_height
@@ -26,120 +143,237 @@ class LaneFit(object):
         self.xm_per_pix = self.lane_width / self.warped_lane_width
 
     def find_lane_pixels(self, binary_warped):
+        points = get_edge_points(binary_warped)
+        left_lane_inds, right_lane_inds = self.find_lane_inds(points)
+        return (
+            points.x[left_lane_inds],
+            points.y[left_lane_inds],
+            points.x[right_lane_inds],
+            points.y[right_lane_inds],
+        )
+
+    def find_lane_inds(self, points):
+        """Sliding window search, returns the left and right masks of points."""
+        # x and y positions of all nonzero pixels in the image
+        # nonzero() scans in row-major order, so nonzeroy is already sorted
+        nonzerox = points.x
+        nonzeroy = points.y
+
         # Take a histogram of the bottom half of the image
         # Lane lines are likely to be mostly vertical nearest to the car
-        histogram = np.sum(binary_warped[binary_warped.shape[0] // 2 :, :], axis=0)
-
-        # Create an output image to draw on and visualize the result
-        out_img = np.dstack((binary_warped, binary_warped, binary_warped))
-        out_img = out_img * 255
+        bottom_half = np.searchsorted(nonzeroy, points.height // 2)
+        histogram = points.get_histogram(bottom_half)
 
         # Find the peak of the left and right halves of the histogram
         # These will be the starting point for the left and right lines
-        midpoint = np.int(histogram.shape[0] // 2)
+        midpoint = int(histogram.shape[0] // 2)
         leftx_base = np.argmax(histogram[:midpoint])
         rightx_base = np.argmax(histogram[midpoint:]) + midpoint
 
-        # HYPERPARAMETERS
+        # HYPERPARAMETERS, at full resolution
         # Choose the number of sliding windows
-        nwindows = 9
+        nwindows = self.n_windows
         # Set the width of the windows +/- margin
-        margin = 100
+        margin = int(round(self.window_margin * self.scale))
         # Set minimum number of pixels found to recenter window
-        minpix = 50
+        minpix = self.min_window_pixels * self.scale * self.scale
 
         # Set height of windows - based on nwindows above and image shape
-        window_height = np.int(binary_warped.shape[0] // nwindows)
+        window_height = int(points.height // nwindows)
 
-        # Identify the x and y positions of all nonzero pixels in the image
-        nonzero = binary_warped.nonzero()
-        nonzeroy = np.array(nonzero[0])
-        nonzerox = np.array(nonzero[1])
+        # Index the pixels by row band once: window i owns the slice
+        # [band_start[i], band_end[i]) of the nonzero arrays
+        win_y_lows = points.height - (np.arange(nwindows) + 1) * window_height
+        win_y_highs = win_y_lows + window_height
+        band_start = np.searchsorted(nonzeroy, win_y_lows, side="left")
+        band_end = np.searchsorted(nonzeroy, win_y_highs, side="left")
 
         # Current positions to be updated later for each window in nwindows
         leftx_current = leftx_base
         rightx_current = rightx_base
 
-        # Create empty lists to receive left and right lane pixel indices
-        left_lane_inds = []
-        right_lane_inds = []
+        # Windows do not overlap, so each one writes only its own band
+        left_lane_inds = np.zeros(len(nonzerox), dtype=bool)
+        right_lane_inds = np.zeros(len(nonzerox), dtype=bool)
+        self.windows = []
 
         # Step through the windows one by one
         for window in range(nwindows):
             # Identify window boundaries in x and y (and right and left)
-            win_y_low = binary_warped.shape[0] - (window + 1) * window_height
-            win_y_high = binary_warped.shape[0] - window * window_height
+            win_y_low = int(win_y_lows[window])
+            win_y_high = int(win_y_highs[window])
 
             win_xleft_low = leftx_current - margin
             win_xleft_high = leftx_current + margin
             win_xright_low = rightx_current - margin
             win_xright_high = rightx_current + margin
 
-            # Draw the windows on the visualization image
-            cv2.rectangle(
-                out_img,
-                (win_xleft_low, win_y_low),
-                (win_xleft_high, win_y_high),
-                (0, 255, 0),
-                2,
-            )
-            cv2.rectangle(
-                out_img,
-                (win_xright_low, win_y_low),
-                (win_xright_high, win_y_high),
-                (0, 255, 0),
-                2,
+            # Keep the windows for the visualization image
+            self.windows.append((win_xleft_low, win_y_low, win_xleft_high, win_y_high))
+            self.windows.append(
+                (win_xright_low, win_y_low, win_xright_high, win_y_high)
             )
 
-            # Identify the nonzero pixels in x and y within the window ###
-            good_left_inds = (
-                (nonzeroy >= win_y_low)
-                & (nonzeroy < win_y_high)
-                & (nonzerox >= win_xleft_low)
-                & (nonzerox < win_xleft_high)
-            ).nonzero()[0]
-            good_right_inds = (
-                (nonzeroy >= win_y_low)
-                & (nonzeroy < win_y_high)
-                & (nonzerox >= win_xright_low)
-                & (nonzerox < win_xright_high)
-            ).nonzero()[0]
-
-            # Append these indices to the lists
-            left_lane_inds.append(good_left_inds)
-            right_lane_inds.append(good_right_inds)
-
-            # If you found > minpix pixels, recenter next window on their mean position
-            if len(good_left_inds) > minpix:
-                leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
-            if len(good_right_inds) > minpix:
-                rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
-
-        # Concatenate the arrays of indices (previously was a list of lists of pixels)
-        try:
-            left_lane_inds = np.concatenate(left_lane_inds)
-            right_lane_inds = np.concatenate(right_lane_inds)
-        except ValueError:
-            # Avoids an error if the above is not implemented fully
-            pass
+            # Identify the nonzero pixels in x within the window band ###
+            start = band_start[window]
+            end = band_end[window]
+            band_x = nonzerox[start:end]
+            good_left = (band_x >= win_xleft_low) & (band_x < win_xleft_high)
+            good_right = (band_x >= win_xright_low) & (band_x < win_xright_high)
 
-        # Extract left and right line pixel positions
-        leftx = nonzerox[left_lane_inds]
-        lefty = nonzeroy[left_lane_inds]
-        rightx = nonzerox[right_lane_inds]
-        righty = nonzeroy[right_lane_inds]
+            # Mark these pixels
+            left_lane_inds[start:end] = good_left
+            right_lane_inds[start:end] = good_right
 
-        return leftx, lefty, rightx, righty, out_img
+            # If you found > minpix pixels, recenter next window on their mean position
+            if points.count(good_left, start) > minpix:
+                leftx_current = int(points.mean_x(good_left, start))
+            if points.count(good_right, start) > minpix:
+                rightx_current = int(points.mean_x(good_right, start))
+
+        return left_lane_inds, right_lane_inds
+
+    def search_around_poly(self, binary_warped):
+        """Collects the pixels within search_margin of the previous fits."""
+        points = get_edge_points(binary_warped)
+        left_lane_inds, right_lane_inds = self.search_around_inds(points)
+        return (
+            points.x[left_lane_inds],
+            points.y[left_lane_inds],
+            points.x[right_lane_inds],
+            points.y[right_lane_inds],
+        )
+
+    def search_around_inds(self, points):
+        """Left and right masks of the points within search_margin of the fits."""
+        self.windows = []
+        nonzerox = points.x
+        nonzeroy = points.y
+
+        margin = self.search_margin * self.scale
+        left_center = np.polyval(rescale_fit(self.left_fit, self.scale), nonzeroy)
+        right_center = np.polyval(rescale_fit(self.right_fit, self.scale), nonzeroy)
+        left_lane_inds = np.abs(nonzerox - left_center) < margin
+        right_lane_inds = np.abs(nonzerox - right_center) < margin
+        return left_lane_inds, right_lane_inds
+
+    def has_fit(self):
+        return self.left_fit is not None and self.right_fit is not None
+
+    def is_sane(self, left_fit, right_fit):
+        """Lane width must be plausible at the bottom and top of the image."""
+        for y in (0, self.image_height - 1):
+            width = np.polyval(right_fit, y) - np.polyval(left_fit, y)
+            if not self.min_lane_width_px <= width <= self.max_lane_width_px:
+                return False
+        return True
+
+    def track(self, points):
+        """
+        Fits the lines from the EdgePoints around the previous fit.
+        Returns None when there are too few pixels or the fit is not sane.
+        """
+        left_lane_inds, right_lane_inds = self.search_around_inds(points)
+        min_pixels = self.min_track_pixels * self.scale * self.scale
+        if (
+            min(points.count(left_lane_inds), points.count(right_lane_inds))
+            < min_pixels
+        ):
+            return None
+
+        left_fit = self.fit_points(points, left_lane_inds)
+        right_fit = self.fit_points(points, right_lane_inds)
+        if not self.is_sane(left_fit, right_fit):
+            return None
+
+        return left_fit, right_fit, left_lane_inds, right_lane_inds
+
+    def fit_line(self, y, x, weights=None):
+        """Second order polynomial x = f(y) of binary pixels, in image pixels."""
+        # polyfit weights multiply the residuals, not their squares
+        w = None if weights is None else np.sqrt(weights)
+        fit = np.polyfit(y, x, 2, w=w)
+        if self.scale != 1:
+            fit = rescale_fit(fit, 1 / self.scale)
+        return fit
+
+    def fit_points(self, points, inds):
+        return self.fit_line(points.y[inds], points.x[inds], points.get_weights(inds))
+
+    def reset(self):
+        """Forgets previous fits, next frame uses the sliding window search."""
+        self.left_fit = None
+        self.right_fit = None
+        self.tracked = False
+        self.prev_fits = None
+
+    def predict(self):
+        """
+        Extrapolates the fits of the last two frames, for a frame that is not
+        searched. The previous fits are kept if the prediction is not sane.
+        """
+        left_fit, right_fit = self.left_fit, self.right_fit
+        if self.prev_fits is not None:
+            prev_left, prev_right = self.prev_fits
+            left = left_fit + self.extrapolation * (left_fit - prev_left)
+            right = right_fit + self.extrapolation * (right_fit - prev_right)
+            if self.is_sane(left, right):
+                self.left_fit, self.right_fit = left, right
+        self.prev_fits = (left_fit, right_fit)
+        self.tracked = False
+
+    def fit_polynomial(self, binary_warped, scale=None):
+        """
+        Fits the lines of binary_warped (a binary or its EdgePoints). A scale can
+        be given for binaries that are not at the constructor scale, e.g. the
+        cheaper path of a real-time mode.
+        """
+        self.scale = self.base_scale if scale is None else scale
+        points = get_edge_points(binary_warped)
+        if self.has_fit():
+            self.prev_fits = (self.left_fit, self.right_fit)
+
+        tracked = None
+        if self.tracking and self.has_fit():
+            tracked = self.track(points)
+        self.tracked = tracked is not None
+
+        if self.tracked:
+            left_fit, right_fit, left_lane_inds, right_lane_inds = tracked
+            self.left_fit = left_fit
+            self.right_fit = right_fit
+        else:
+            # Find our lane pixels first
+            left_lane_inds, right_lane_inds = self.find_lane_inds(points)
+
+            # Fit a second order polynomial to each using `np.polyfit`
+            self.left_fit = self.fit_points(points, left_lane_inds)
+            self.right_fit = self.fit_points(points, right_lane_inds)
+
+        self.lane_pixels = (
+            points.x[left_lane_inds],
+            points.y[left_lane_inds],
+            points.x[right_lane_inds],
+            points.y[right_lane_inds],
+        )
 
-    def fit_polynomial(self, binary_warped):
-        # Find our lane pixels first
-        leftx, lefty, rightx, righty, out_img = self.find_lane_pixels(binary_warped)
+        # Visualization
+        if self.vis_level >= VisLevel.DEBUG:
+            return self.build_lanes_vis(binary_warped)
+        return None
+
+    def build_lanes_vis(self, binary_warped):
+        """Debug image of the last fit: search windows, lane pixels and polynomials."""
+        if isinstance(binary_warped, EdgePoints):
+            binary_warped = binary_warped.to_binary()
+        out_img = np.dstack((binary_warped, binary_warped, binary_warped))
+        out_img = out_img * 255
 
-        # Fit a second order polynomial to each using `np.polyfit`
-        self.left_fit = np.polyfit(lefty, leftx, 2)
-        self.right_fit = np.polyfit(righty, rightx, 2)
+        # Draw the windows on the visualization image
+        for x_low, y_low, x_high, y_high in self.windows:
+            cv2.rectangle(out_img, (x_low, y_low), (x_high, y_high), (0, 255, 0), 2)
 
-        # Visualization
+        leftx, lefty, rightx, righty = self.lane_pixels
         self.draw_lanes(out_img, leftx, lefty, rightx, righty)
         return out_img
 
@@ -153,7 +387,7 @@ class LaneFit(object):
             print("The function failed to fit a line!")
 
     def get_fitpoints(self):
-        points_y = list(range(self.image_height))
+        points_y = np.arange(self.image_height)
         left_fitx = np.polyval(self.left_fit, points_y)
         right_fitx = np.polyval(self.right_fit, points_y)
         return points_y, left_fitx, right_fitx
@@ -163,9 +397,9 @@ class LaneFit(object):
         image[lefty, leftx] = [255, 0, 0]
         image[righty, rightx] = [0, 0, 255]
 
-        # Draw fitted polynomial
-        self.draw_polyfit(image, self.left_fit)
-        self.draw_polyfit(image, self.right_fit)
+        # Draw fitted polynomial, in binary pixels
+        self.draw_polyfit(image, rescale_fit(self.left_fit, self.scale))
+        self.draw_polyfit(image, rescale_fit(self.right_fit, self.scale))
 
     def get_curvature_px(self):
         """Calculates the curvature of polynomial functions in pixels."""
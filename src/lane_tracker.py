@@ -1,41 +1,32 @@
 import cv2
 import numpy as np
-from moviepy.editor import VideoFileClip
 
+from . import tracing
 from .logger import Log
 from .calibration import GetCalibratedCamera, WarpMachine
 from .filtering import EdgeDetector
-from .lane_fitting import LaneFit
-from .save import chmod_rw_all, delete_file
-from .profiler import Profiler
+from .lane_fitting import LaneFit, EdgePoints
+from .profiler import (
+    Profiler,
+    export_profilers,
+    enable_memory_tracking,
+    disable_memory_tracking,
+)
+from .video_io import open_clip, VideoWriter
+from .parallel import process_video_parallel
+from .pipeline import process_video_threaded
+from .stage_cache import StageCache, process_video_cached
+from .telemetry import process_video_telemetry
+from .realtime import DeadlineController, Level
+from .visualization import VisLevel
 
 
-def draw_overlay(warper, lane_fitting, undistorted, warped):
+def draw_lane_info(image, lane_fitting):
+    """Writes the curvature and vehicle position on image."""
     # get curvature and vehicle position
     left_cr, right_cr = lane_fitting.get_curvature()
     pos = lane_fitting.get_vehicle_position()
 
-    # get fitpoints
-    pts_y, left_fitx, right_fitx = lane_fitting.get_fitpoints()
-
-    # Create an image to draw the lines on
-    warp_zero = np.zeros_like(warped).astype(np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
-
-    # Recast the x and y points into usable format for cv2.fillPoly()
-    pts_left = np.array([np.transpose(np.vstack([left_fitx, pts_y]))])
-    pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, pts_y])))])
-    pts = np.hstack((pts_left, pts_right))
-
-    # Draw the lane onto the warped blank image
-    cv2.fillPoly(color_warp, np.int_([pts]), (0, 255, 0))
-
-    # Warp the blank back to original image space using inverse perspective matrix (Minv)
-    overlay = warper.unwarp(color_warp)
-
-    # Combine the result with the original image
-    vis_overlay = cv2.addWeighted(undistorted, 1, overlay, 0.3, 0)
-
     pos_str = "Left" if pos < 0 else "Right"
     crl_text = "Radius of curvature (left) = %.1f km" % (left_cr / 1000)
     crr_text = "Radius of curvature (right) = %.1f km" % (right_cr / 1000)
@@ -46,89 +37,579 @@ def draw_overlay(warper, lane_fitting, undistorted, warped):
         font = cv2.FONT_HERSHEY_SIMPLEX
         cv2.putText(image, text, (350, ypos), font, 1, color, 2, cv2.LINE_AA)
 
-    put_text(vis_overlay, crl_text, ypos=50)
-    put_text(vis_overlay, crr_text, ypos=100)
-    put_text(vis_overlay, cr_text, ypos=150)
-    put_text(vis_overlay, pos_text, ypos=200)
+    put_text(image, crl_text, ypos=50)
+    put_text(image, crr_text, ypos=100)
+    put_text(image, cr_text, ypos=150)
+    put_text(image, pos_text, ypos=200)
 
-    return vis_overlay
 
+class OverlayRenderer(object):
+    """
+    Draws the lane area between the fits on undistorted frames.
+
+    The boundary of the lane polygon is projected to the frame with the inverse
+    perspective transform and filled there, and only its bounding box is
+    blended, instead of filling, unwarping and blending whole frames.
+    """
+
+    # bird's-eye rows between two points of the polygon sides
+    row_step = 8
+
+    # added inside the lane, as addWeighted with a 0.3 * (0, 255, 0) overlay
+    color = (0, 76, 0)
+
+    # fixed-point bits of the polygon vertices
+    shift = 4
 
-class LaneLinesTracker(object):
     def __init__(self):
-        self.camera = GetCalibratedCamera()
+        self.rows = None
+        self.buffer = None
+
+    def get_rows(self, h):
+        """
+        Cached bird's-eye rows of the polygon points, from the top edge of the
+        first pixel row to the bottom edge of the last one.
+        """
+        if self.rows is None or self.rows[-1] != h - 0.5:
+            rows = np.arange(0, h, self.row_step, dtype=np.float64)
+            rows[0] = -0.5
+            self.rows = np.append(rows, h - 0.5)
+        return self.rows
+
+    def get_polygon(self, warper, lane_fitting):
+        """Lane polygon in frame pixels, as a (N, 2) float32 array."""
+        w = lane_fitting.image_width
+        ys = self.get_rows(lane_fitting.image_height)
+        n = len(ys)
+
+        # clipped to the bird's-eye image, like a polygon drawn in it
+        pts = np.empty((2 * n, 1, 2), np.float32)
+        pts[:n, 0, 0] = np.clip(np.polyval(lane_fitting.left_fit, ys), -0.5, w - 0.5)
+        pts[:n, 0, 1] = ys
+        pts[n:, 0, 0] = np.clip(np.polyval(lane_fitting.right_fit, ys), -0.5, w - 0.5)[
+            ::-1
+        ]
+        pts[n:, 0, 1] = ys[::-1]
+
+        return cv2.perspectiveTransform(pts, warper.Minv).reshape(-1, 2)
+
+    def draw(self, warper, lane_fitting, undistorted):
+        """Returns a new image: undistorted with the lane area and lane info."""
+        vis_overlay = undistorted.copy()
+        h, w = undistorted.shape[:2]
+
+        pts = self.get_polygon(warper, lane_fitting)
+        x0 = max(int(np.floor(pts[:, 0].min())), 0)
+        y0 = max(int(np.floor(pts[:, 1].min())), 0)
+        x1 = min(int(np.ceil(pts[:, 0].max())) + 1, w)
+        y1 = min(int(np.ceil(pts[:, 1].max())) + 1, h)
+
+        if x0 < x1 and y0 < y1:
+            if self.buffer is None or self.buffer.shape != undistorted.shape:
+                self.buffer = np.empty_like(undistorted)
+
+            # fill the polygon in the bounding box only, then add it
+            area = self.buffer[y0:y1, x0:x1]
+            area[:] = 0
+            vertices = np.int32(np.round((pts - (x0, y0)) * (1 << self.shift)))
+            cv2.fillPoly(area, [vertices], self.color, cv2.LINE_AA, self.shift)
+            roi = vis_overlay[y0:y1, x0:x1]
+            cv2.add(roi, area, dst=roi)
+
+        draw_lane_info(vis_overlay, lane_fitting)
+        return vis_overlay
+
+
+# shared by the draw_overlay calls
+_renderer = OverlayRenderer()
+
+
+def draw_overlay(warper, lane_fitting, undistorted):
+    return _renderer.draw(warper, lane_fitting, undistorted)
+
+
+class LaneResult(object):
+    """Lane geometry of a processed frame, and its overlay when drawn."""
+
+    def __init__(self, index, lane_fitting, overlay=None, level=Level.FULL):
+        self.index = index
+        self.level = level
+        self.left_fit = lane_fitting.left_fit
+        self.right_fit = lane_fitting.right_fit
+        self.curvature = lane_fitting.get_curvature()
+        self.position = lane_fitting.get_vehicle_position()
+        self.tracked = lane_fitting.tracked
+        self.overlay = overlay
+
+    def to_dict(self):
+        """JSON friendly values, without the overlay."""
+        return dict(
+            index=self.index,
+            left_fit=[float(c) for c in self.left_fit],
+            right_fit=[float(c) for c in self.right_fit],
+            curvature=[float(c) for c in self.curvature],
+            position=float(self.position),
+            tracked=bool(self.tracked),
+            level=Level.NAMES[self.level],
+        )
+
+
+class EdgeMode:
+    """Where edge detection runs in the pipeline."""
+
+    # full undistorted frame, then warp the binary
+    FULL = "full"
+    # bounding box of the warp src trapezoid (+ Sobel halo), then warp the binary
+    ROI = "roi"
+    # undistort+warp the color image in one remap, detect in bird's-eye space
+    WARP_FIRST = "warp_first"
+    # full undistorted frame, then warp the coordinates of the edge pixels only
+    # (scale >= min_points_scale: below, the few far field points weigh as much
+    # as the lane near the car in the histogram base search)
+    POINTS = "points"
+
+
+class LaneLinesTracker(object):
+
+    # scale of the REDUCED real-time level, relative to scale
+    reduced_scale = 0.5
+
+    # smallest scale validated for EdgeMode.POINTS
+    min_points_scale = 0.5
+
+    def __init__(
+        self,
+        edge_mode=EdgeMode.FULL,
+        tracking=True,
+        vis_level=VisLevel.OVERLAY,
+        camera=None,
+        scale=1.0,
+        frame_budget=None,
+    ):
+        if edge_mode == EdgeMode.POINTS and scale < self.min_points_scale:
+            raise ValueError(
+                "EdgeMode.POINTS needs scale >= %g, got %g"
+                % (self.min_points_scale, scale)
+            )
+
+        # an already calibrated camera can be shared, e.g. with pool workers
+        self.camera = camera or GetCalibratedCamera()
         self.warper = WarpMachine()
+        self.edge_mode = edge_mode
+        self.vis_level = vis_level
+        self.edge_detector = EdgeDetector(vis_level=vis_level)
+
+        # detection, warp and fitting run on frames downscaled by scale, lane
+        # fits are rescaled to full resolution
+        self.scale = scale
+        self.scaled_warper = WarpMachine(scale)
+        if scale != 1:
+            # same Sobel footprint on the road (odd size, at least 3)
+            kernel_size = self.edge_detector.sobel.kernel_size
+            self.edge_detector.sobel.kernel_size = max(int(kernel_size * scale) | 1, 3)
+
+        # real-time mode: cheaper levels for frames when behind frame_budget [s]
+        self.frame_budget = frame_budget
+        self.deadline = None
+        self.reduced = None
+        if frame_budget:
+            self.deadline = DeadlineController(frame_budget)
+
+        self.renderer = OverlayRenderer()
+
+        # per frame stage outputs, see process_video_cached
+        self.stage_cache = None
+
+        # last frame intermediates, for debug images on request
+        self.undistorted = None
+        self.warped = None
+
+        # per-stream lane state, kept between frames
+        self.tracking = tracking
+        self.lane_fitting = None
+
+        # index of the next frame, to tag trace events
+        self.frame_index = 0
 
         # profiling
         self.p_video = Profiler("Total Time")
+        self.p_frame = Profiler("Frame")
         self.p_undistort = Profiler("Distortion  Correction")
         self.p_edges = Profiler("Edge Detection")
         self.p_warp = Profiler("Perspective Transform")
         self.p_fitting = Profiler("Lane Fitting")
         self.p_overlay = Profiler("Overlay Drawing")
 
-    def process_video(self, input_file, output_file, subclip_seconds=None):
-        # delete output file to avoid permission problems between docker/user on write
-        delete_file(output_file)
+    def get_config(self):
+        """Constructor arguments to build an equivalent tracker."""
+        return dict(
+            edge_mode=self.edge_mode,
+            tracking=self.tracking,
+            vis_level=self.vis_level,
+            scale=self.scale,
+            frame_budget=self.frame_budget,
+        )
+
+    def get_stage_profilers(self):
+        return [
+            self.p_frame,
+            self.p_undistort,
+            self.p_edges,
+            self.p_warp,
+            self.p_fitting,
+            self.p_overlay,
+        ]
+
+    def get_stage_marks(self):
+        return [p.mark() for p in self.get_stage_profilers()]
+
+    def get_stage_samples(self, marks):
+        """Stage (samples, memory peaks, net memory, max RSS) since get_stage_marks()."""
+        profilers = self.get_stage_profilers()
+        return [
+            (p.samples_since(mark), p.peaks_since(mark), p.nets_since(mark), p.max_rss)
+            for p, mark in zip(profilers, marks)
+        ]
+
+    def add_stage_samples(self, samples):
+        for profiler, stage_samples in zip(self.get_stage_profilers(), samples):
+            profiler.add_samples(*stage_samples)
+
+    def process_video(
+        self,
+        input_file,
+        output_file,
+        subclip_seconds=None,
+        workers=1,
+        threaded=False,
+        cached=False,
+        profile_file=None,
+        trace_file=None,
+        memory=False,
+        telemetry_file=None,
+        **kwargs
+    ):
+        """
+        Processes the video frame by frame. With workers > 1 frames are processed
+        by a pool of processes, see process_video_parallel for kwargs. With
+        threaded=True decoding, processing and encoding run as overlapping
+        stages, see process_video_threaded for kwargs. With cached=True stage
+        outputs are reused between runs, see process_video_cached. With a
+        telemetry_file nothing is drawn nor encoded (output_file is unused) and
+        the lane geometry of each frame is written instead, see
+        process_video_telemetry for kwargs. These modes are exclusive, a
+        ValueError is raised when several are requested.
+
+        Profiling statistics are written to profile_file (.json or .csv) if given,
+        and a timeline of the stages to trace_file (Chrome trace-event JSON).
+        With memory=True the allocations and RSS of each stage are recorded too,
+        see enable_memory_tracking.
+        """
+        modes = [
+            name
+            for name, enabled in (
+                ("telemetry_file", telemetry_file),
+                ("workers > 1", workers > 1),
+                ("cached", cached),
+                ("threaded", threaded),
+            )
+            if enabled
+        ]
+        if len(modes) > 1:
+            raise ValueError("Conflicting video modes: %s" % ", ".join(modes))
+
+        if trace_file:
+            tracing.enable()
+        if memory:
+            enable_memory_tracking()
 
         self.p_video.start()
 
-        # read
-        Log.subsection("Reading video file: %s" % input_file)
-        clip = VideoFileClip(input_file)
+        if telemetry_file:
+            clip = process_video_telemetry(
+                self, input_file, telemetry_file, subclip_seconds, **kwargs
+            )
+        elif workers > 1:
+            clip = process_video_parallel(
+                self, input_file, output_file, subclip_seconds, workers, **kwargs
+            )
+        elif cached:
+            clip = process_video_cached(
+                self, input_file, output_file, subclip_seconds, **kwargs
+            )
+        elif threaded:
+            clip = process_video_threaded(
+                self, input_file, output_file, subclip_seconds, **kwargs
+            )
+        else:
+            clip = self.process_video_serial(input_file, output_file, subclip_seconds)
+        self.p_video.update()
 
-        # subclip
-        if subclip_seconds:
-            Log.info("Clipping video to: %.1f s" % subclip_seconds)
-            clip = clip.subclip(0, subclip_seconds)
+        self.display_profiling(clip.duration)
+        if profile_file:
+            export_profilers([self.p_video] + self.get_stage_profilers(), profile_file)
+        if trace_file:
+            tracing.disable().save(trace_file)
+        if memory:
+            disable_memory_tracking()
 
-        # set image handler
-        Log.info("Setting Image Handler ...")
-        clip = clip.fl_image(self.process_image)
+    def process_video_serial(self, input_file, output_file, subclip_seconds=None):
+        # read
+        clip = open_clip(input_file, subclip_seconds)
 
-        # process / save
+        # process / save, one frame at a time
         Log.subsection("Processing Video ...")
-        clip.write_videofile(output_file, audio=False, verbose=False)
-        chmod_rw_all(output_file)
-        self.p_video.update()
+        with VideoWriter(output_file, clip.size, clip.fps) as writer:
+            for frame in tracing.traced_iter(clip.iter_frames(), "Decode"):
+                writer.write(self.process_image(frame))
+
+        return clip
 
-        # display profiling results
+    def display_profiling(self, duration):
         Log.subsection("Profiling Results ...")
         total_secs = self.p_video.get_elapsed()
         self.p_video.display_elapsed(total_secs)
-        self.p_undistort.display_elapsed(total_secs)
-        self.p_edges.display_elapsed(total_secs)
-        self.p_warp.display_elapsed(total_secs)
-        self.p_fitting.display_elapsed(total_secs)
-        self.p_overlay.display_elapsed(total_secs)
-        self.p_video.display_processing_factor(clip.duration)
+        for profiler in self.get_stage_profilers():
+            profiler.display_elapsed(total_secs)
+        self.p_video.display_processing_factor(duration)
+
+        Log.subsection("Per Frame Latency ...")
+        for profiler in self.get_stage_profilers():
+            for p in profiler.walk():
+                p.display_stats()
+
+        if self.deadline is not None:
+            Log.subsection("Real-Time Levels ...")
+            self.deadline.display_stats()
+
+    def set_vis_level(self, vis_level):
+        self.vis_level = vis_level
+        self.edge_detector.vis_level = vis_level
+        if self.lane_fitting is not None:
+            self.lane_fitting.vis_level = vis_level
+
+    def get_lane_fitting(self, w, h):
+        lane_fitting = self.lane_fitting
+        if lane_fitting is None or (
+            lane_fitting.image_width,
+            lane_fitting.image_height,
+        ) != (w, h):
+            lane_fitting = LaneFit(
+                w, h, tracking=self.tracking, vis_level=self.vis_level, scale=self.scale
+            )
+            self.lane_fitting = lane_fitting
+        return lane_fitting
+
+    def get_reduced(self):
+        """Tracker running the detection of the REDUCED real-time level."""
+        if self.reduced is None:
+            edge_mode = self.edge_mode
+            if edge_mode in (EdgeMode.FULL, EdgeMode.POINTS):
+                edge_mode = EdgeMode.ROI
+            self.reduced = LaneLinesTracker(
+                edge_mode=edge_mode,
+                tracking=False,
+                vis_level=VisLevel.NONE,
+                camera=self.camera,
+                scale=self.scale * self.reduced_scale,
+            )
+        return self.reduced
+
+    def reset(self):
+        """Drops the temporal state, e.g. between unrelated clips."""
+        if self.lane_fitting is not None:
+            self.lane_fitting.reset()
+
+    def build_edges_vis(self):
+        """Debug image of the last edge detection."""
+        return self.edge_detector.build_result_vis()
+
+    def build_lanes_vis(self):
+        """Debug image of the last lane fitting."""
+        return self.lane_fitting.build_lanes_vis(self.warped)
 
     def process_image(self, image):
-        # Distortion correction
-        self.p_undistort.start()
-        undistorted = self.camera.undistort(image)
-        self.p_undistort.update()
+        """
+        Returns the overlay image. With VisLevel.NONE nothing is drawn and the
+        undistorted frame is returned as is (the raw frame in WARP_FIRST mode or
+        with scale < 1, where full resolution undistortion is only needed for
+        drawing).
+        """
+        result = self.process_frame(image)
+        if result.overlay is None:
+            return self.undistorted
+        return result.overlay
 
-        # Edge Detection
-        self.p_edges.start()
-        edge_detector = EdgeDetector()
-        edges = edge_detector.detect(undistorted)
-        self.p_edges.update()
+    def process_stream(self, frames):
+        """
+        Processes an iterable of RGB frames (e.g. a camera grabber or a raw
+        video pipe) lazily, yielding one LaneResult per frame as it is ready.
+        """
+        for index, frame in enumerate(frames):
+            yield self.process_frame(frame, index)
 
-        # Perspective Transform
-        self.p_warp.start()
-        warped = self.warper.warp(edges)
-        self.p_warp.update()
+    def process_frame(self, image, index=None):
+        """
+        Runs the pipeline on a single RGB frame and returns its LaneResult.
+        With a stage cache set, stage outputs are looked up by frame index and the
+        image may be None when every needed stage is cached.
+        """
+        if index is not None:
+            self.frame_index = index
+        tracing.set_frame(self.frame_index)
+        self.frame_index += 1
+        self.p_frame.start()
+
+        stage_cache = self.stage_cache if index is not None else None
+
+        level = Level.FULL
+        if self.deadline is not None:
+            has_fit = self.lane_fitting is not None and self.lane_fitting.has_fit()
+            level = self.deadline.next_level(has_fit)
+
+        warped = None
+        if stage_cache is not None and self.edge_mode != EdgeMode.POINTS:
+            warped = stage_cache.load_binary(StageCache.WARPED, index)
+
+        # Distortion correction (full resolution)
+        undistorted = None
+        if (
+            stage_cache is not None
+            or self.vis_level > VisLevel.NONE
+            or (
+                level == Level.FULL
+                and self.edge_mode != EdgeMode.WARP_FIRST
+                and self.scale == 1
+            )
+        ):
+            undistorted = self.get_undistorted(image, index)
+
+        # Edge Detection + Perspective Transform
+        scale = self.scale
+        if level == Level.REDUCED:
+            reduced = self.get_reduced()
+            scale = reduced.scale
+            warped = reduced.get_warped(image, undistorted)
+        elif level == Level.FULL and warped is None:
+            warped = self.get_warped(image, undistorted, index)
 
         # Lane Fitting
         self.p_fitting.start()
-        lane_fitting = LaneFit(image.shape[1], image.shape[0])
-        vis_lanes = lane_fitting.fit_polynomial(warped)
+        h, w = (image if undistorted is None else undistorted).shape[:2]
+        lane_fitting = self.get_lane_fitting(w, h)
+        if level == Level.PREDICT:
+            lane_fitting.predict()
+        else:
+            lane_fitting.fit_polynomial(warped, scale)
         self.p_fitting.update()
 
+        self.undistorted = image if undistorted is None else undistorted
+        if warped is not None:
+            self.warped = warped
+        result = LaneResult(index, lane_fitting, level=level)
+
         # Draw Overlay
-        self.p_overlay.start()
-        vis_overlay = draw_overlay(self.warper, lane_fitting, undistorted, warped)
-        self.p_overlay.update()
+        if self.vis_level > VisLevel.NONE:
+            self.p_overlay.start()
+            result.overlay = self.renderer.draw(self.warper, lane_fitting, undistorted)
+            self.p_overlay.update()
 
-        return vis_overlay
+        self.p_frame.update()
+        if self.deadline is not None:
+            self.deadline.update(level, self.p_frame.get_last())
+        return result
+
+    def get_cached_stages(self):
+        """Stages a stage cache must hold for frames to be processed without input."""
+        if self.edge_mode == EdgeMode.POINTS:
+            return [StageCache.UNDISTORTED, StageCache.EDGES]
+        return [StageCache.UNDISTORTED, StageCache.WARPED]
+
+    def get_undistorted(self, image, index=None):
+        stage_cache = self.stage_cache if index is not None else None
+        if stage_cache is not None:
+            undistorted = stage_cache.load_image(StageCache.UNDISTORTED, index)
+            if undistorted is not None:
+                return undistorted
+
+        self.p_undistort.start()
+        undistorted = self.camera.undistort(image)
+        self.p_undistort.update()
+
+        if stage_cache is not None:
+            stage_cache.save_image(StageCache.UNDISTORTED, index, undistorted)
+        return undistorted
+
+    def get_scaled(self, image, undistorted):
+        """
+        Undistorted frame at the processing scale. It is always computed from
+        the raw frame, whether the full resolution frame is there for drawing or
+        not, so the lane geometry does not depend on the vis_level.
+        """
+        if self.scale == 1:
+            return undistorted
+
+        if image is not None:
+            # area-averaged downscale, then undistort in a single remap
+            self.p_undistort.start()
+            scaled = self.camera.undistort(image, self.scale)
+            self.p_undistort.update()
+            return scaled
+
+        # no raw frame (stage cache), downscale the undistorted one
+        p_downscale = self.p_undistort.child("Downscale")
+        p_downscale.start()
+        h, w = undistorted.shape[:2]
+        size = (int(round(w * self.scale)), int(round(h * self.scale)))
+        scaled = cv2.resize(undistorted, size, interpolation=cv2.INTER_AREA)
+        p_downscale.update()
+        return scaled
+
+    def get_warped(self, image, undistorted, index=None):
+        """
+        Bird's-eye edge binary at the processing scale, following edge_mode
+        (its EdgePoints in POINTS mode).
+        """
+        stage_cache = self.stage_cache if index is not None else None
+        edge_detector = self.edge_detector
+        warper = self.scaled_warper
+        if self.edge_mode == EdgeMode.WARP_FIRST:
+            self.p_warp.start()
+            birdseye = self.camera.undistort_warp(image, self.warper.M, self.scale)
+            self.p_warp.update()
+
+            self.p_edges.start()
+            warped = edge_detector.detect(birdseye)
+            self.p_edges.update()
+        else:
+            edges = None
+            if stage_cache is not None:
+                edges = stage_cache.load_binary(StageCache.EDGES, index)
+
+            if edges is None:
+                scaled = self.get_scaled(image, undistorted)
+                self.p_edges.start()
+                if self.edge_mode == EdgeMode.ROI:
+                    h, w = scaled.shape[:2]
+                    roi = warper.get_roi(w, h, edge_detector.get_halo())
+                    edges = edge_detector.detect_roi(scaled, roi)
+                else:
+                    edges = edge_detector.detect(scaled)
+                self.p_edges.update()
+
+                if stage_cache is not None:
+                    stage_cache.save_binary(StageCache.EDGES, index, edges)
+
+            self.p_warp.start()
+            if self.edge_mode == EdgeMode.POINTS:
+                h, w = edges.shape[:2]
+                x, y, area, span = warper.warp_points(edges)
+                warped = EdgePoints(x, y, w, h, area, span)
+            else:
+                warped = warper.warp(edges)
+            self.p_warp.update()
+
+        # EdgePoints are rebuilt from the cached edges, a binary would lose weights
+        if stage_cache is not None and self.edge_mode != EdgeMode.POINTS:
+            stage_cache.save_binary(StageCache.WARPED, index, warped)
+        return warped
@@ -2,31 +2,34 @@ try:
     from termcolor import cprint
 except ImportError:
 
-    def cprint(text, color, attrs=[]):
-        print(text)
+    def cprint(text, color, attrs=[], **kwargs):
+        print(text, **kwargs)
 
 
 class Log:
 
     debug_enabled = False
 
+    # None is stdout, set to sys.stderr when stdout carries data
+    file = None
+
     def section(text):
-        print("=" * 40)
-        cprint(text, "white", attrs=["bold"])
-        print("-" * 40)
+        print("=" * 40, file=Log.file)
+        cprint(text, "white", attrs=["bold"], file=Log.file)
+        print("-" * 40, file=Log.file)
 
     def subsection(text):
-        cprint("> %s" % text, "white", attrs=["bold"])
+        cprint("> %s" % text, "white", attrs=["bold"], file=Log.file)
 
     def info(text):
-        cprint(" - %s" % text, "white")
+        cprint(" - %s" % text, "white", file=Log.file)
 
     def debug(text):
         if Log.debug_enabled:
-            cprint(" - %s" % text, "grey", attrs=["bold"])
+            cprint(" - %s" % text, "grey", attrs=["bold"], file=Log.file)
 
     def warn(text):
-        cprint(" !! %s" % text, "yellow")
+        cprint(" !! %s" % text, "yellow", file=Log.file)
 
     def success():
-        cprint(" - ok\n", "green")
+        cprint(" - ok\n", "green", file=Log.file)
@@ -0,0 +1,176 @@
+import multiprocessing
+from collections import deque
+
+import cv2
+
+from . import tracing
+from .logger import Log
+from .profiler import enable_memory_tracking, is_memory_tracking
+from .video_io import open_clip, VideoWriter
+from .frame_store import FrameStore
+from .visualization import VisLevel
+
+# tracker owned by a pool worker, built once by the pool initializer
+_tracker = None
+
+# frame stores mapped by a pool worker, by file name
+_stores = dict()
+
+
+def _init_worker(tracker_class, tracker_config, trace=False, memory=False):
+    global _tracker
+    # parallelism comes from the pool, avoid oversubscribing cores
+    cv2.setNumThreads(1)
+    _tracker = tracker_class(**tracker_config)
+
+    # a forked worker inherits the tracer of the parent, start with a new one
+    tracing.disable()
+    if trace:
+        tracing.enable()
+    if memory:
+        enable_memory_tracking()
+
+
+def _process_chunk(start, warmup, frames):
+    """
+    Processes a contiguous chunk of frames in a pool worker, start being the
+    index of its first frame.
+
+    Chunks are processed out of order, so the temporal state is reset at the
+    chunk start. The warmup frames (the tail of the previous chunk) are only
+    used to rebuild that state, so they are processed without drawing.
+
+    Returns the overlays, the stage samples and the trace events (if tracing).
+    """
+    _tracker.reset()
+    _tracker.frame_index = start - len(warmup)
+    if len(warmup):
+        vis_level = _tracker.vis_level
+        _tracker.set_vis_level(VisLevel.NONE)
+        for frame in warmup:
+            _tracker.process_frame(frame)
+        _tracker.set_vis_level(vis_level)
+
+    marks = _tracker.get_stage_marks()
+    results = [_tracker.process_image(frame) for frame in frames]
+
+    tracer = tracing.get_tracer()
+    events = tracer.drain() if tracer is not None else None
+    return results, _tracker.get_stage_samples(marks), events
+
+
+def _process_store_chunk(store_file, start, stop, overlap):
+    """
+    Like _process_chunk, but the worker reads frames [start, stop) straight from
+    the memory-mapped frame store instead of receiving copies.
+    """
+    if store_file not in _stores:
+        _stores[store_file] = FrameStore(store_file)
+    frames = _stores[store_file].frames
+    warmup = frames[max(start - overlap, 0) : start]
+    return _process_chunk(start, warmup, frames[start:stop])
+
+
+def iter_store_chunks(store, chunk_size):
+    """Yields (start, stop) frame ranges of the underlying frame store file."""
+    for start in range(store.start, store.stop, chunk_size):
+        yield start, min(start + chunk_size, store.stop)
+
+
+def iter_chunks(frames, chunk_size, overlap=0):
+    """Yields (start, warmup, chunk), warmup and chunk being lists of contiguous frames."""
+    start = 0
+    warmup = []
+    chunk = []
+    for frame in frames:
+        chunk.append(frame)
+        if len(chunk) == chunk_size:
+            yield start, warmup, chunk
+            start += len(chunk)
+            warmup = chunk[-overlap:] if overlap > 0 else []
+            chunk = []
+    if chunk:
+        yield start, warmup, chunk
+
+
+def process_video_parallel(
+    tracker,
+    input_file,
+    output_file,
+    subclip_seconds=None,
+    workers=None,
+    chunk_size=64,
+    max_inflight=None,
+    overlap=8,
+):
+    """
+    Processes video frames in a pool of worker processes, each one with its own
+    tracker (camera model, warper and lane state) configured like tracker.
+
+    Results are encoded in the original order. At most max_inflight chunks are
+    decoded and not yet encoded, which bounds memory to about
+    max_inflight * chunk_size frames. Stage timing samples are added to the
+    profilers of tracker.
+
+    Each chunk starts from a reset lane state, rebuilt from the overlap frames
+    before it: with overlap=8 the fits match the serial ones, with overlap=0
+    the first frames of every chunk fall back to the sliding window search.
+    Without tracking there is no state to rebuild and no overlap.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    max_inflight = max_inflight or workers + 1
+    if not tracker.tracking:
+        overlap = 0
+
+    clip = open_clip(input_file, subclip_seconds)
+
+    Log.subsection(
+        "Processing Video on %d workers (chunk size: %d, in flight: %d) ..."
+        % (workers, chunk_size, max_inflight)
+    )
+    tracer = tracing.get_tracer()
+    init_args = (
+        type(tracker),
+        tracker.get_config(),
+        tracer is not None,
+        is_memory_tracking(),
+    )
+    pool = multiprocessing.Pool(workers, _init_worker, init_args)
+    pending = deque()
+
+    def write_next(writer):
+        results, samples, events = pending.popleft().get()
+        tracker.add_stage_samples(samples)
+        if events is not None:
+            tracer.merge(events)
+        for frame in results:
+            writer.write(frame)
+
+    try:
+        with VideoWriter(output_file, clip.size, clip.fps) as writer:
+            if isinstance(clip, FrameStore):
+                tasks = (
+                    (_process_store_chunk, (clip.store_file, start, stop, overlap))
+                    for start, stop in iter_store_chunks(clip, chunk_size)
+                )
+            else:
+                tasks = (
+                    (_process_chunk, (start, warmup, chunk))
+                    for start, warmup, chunk in iter_chunks(
+                        tracing.traced_iter(clip.iter_frames(), "Decode"),
+                        chunk_size,
+                        overlap,
+                    )
+                )
+            for task, args in tasks:
+                pending.append(pool.apply_async(task, args))
+                if len(pending) >= max_inflight:
+                    write_next(writer)
+            while pending:
+                write_next(writer)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return clip
@@ -0,0 +1,186 @@
+import time
+import queue
+import threading
+
+from . import tracing
+from .logger import Log
+from .video_io import open_clip, VideoWriter
+
+# marks the end of the stream in a stage queue
+_END = object()
+
+
+class StageQueue(object):
+    """
+    Bounded queue between two pipeline stages, with depth and wait statistics.
+
+    Blocked puts and gets give up once the shared stop event is set (a stage
+    failed), so that no stage waits forever on a stage that is gone.
+    """
+
+    # seconds between checks of the stop event while blocked
+    poll_interval = 0.1
+
+    def __init__(self, name, maxsize, stop):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.stop = stop
+
+        # statistics
+        self.n_samples = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put(self, item):
+        """Returns False if the item was dropped because the pipeline stopped."""
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    self.queue.put(item, timeout=self.poll_interval)
+                    return True
+                except queue.Full:
+                    if self.stop.is_set():
+                        return False
+        finally:
+            self.put_wait += time.perf_counter() - start
+
+    def get(self):
+        """Returns _END once the queue is empty and the pipeline stopped."""
+        start = time.perf_counter()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                if self.stop.is_set():
+                    self.get_wait += time.perf_counter() - start
+                    return _END
+        self.get_wait += time.perf_counter() - start
+
+        # depth as seen by the consumer, before this item was taken
+        depth = self.queue.qsize() + 1
+        self.n_samples += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        return item
+
+    def get_mean_depth(self):
+        return self.depth_sum / self.n_samples if self.n_samples else 0.0
+
+    def display_stats(self):
+        """
+        A queue that is mostly full with a waiting producer means its consumer
+        is the bottleneck, a mostly empty one means its producer is.
+        """
+        name = self.name.ljust(30)
+        Log.info(
+            "%s:  depth mean %4.1f max %2d / %2d, producer wait %6.2f s, consumer wait %6.2f s"
+            % (
+                name,
+                self.get_mean_depth(),
+                self.max_depth,
+                self.maxsize,
+                self.put_wait,
+                self.get_wait,
+            )
+        )
+
+
+class StageThread(threading.Thread):
+    """
+    Runs a stage function, keeping its exception to re-raise on join. A failed
+    stage sets the stop event to release the other stages.
+    """
+
+    def __init__(self, name, target, stop):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.stage = target
+        self.stop = stop
+        self.error = None
+
+    def run(self):
+        try:
+            self.stage()
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+
+    def join_checked(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def process_video_threaded(
+    tracker, input_file, output_file, subclip_seconds=None, queue_size=8
+):
+    """
+    Overlaps decoding, processing and encoding: a decoder thread and an encoder
+    thread are connected to the processing stage (the calling thread) by bounded
+    queues, so a slow stage applies backpressure instead of buffering frames.
+    The heavy OpenCV and ffmpeg work releases the GIL while it runs.
+    """
+    clip = open_clip(input_file, subclip_seconds)
+    stop = threading.Event()
+    decoded = StageQueue("Decode -> Process", queue_size, stop)
+    processed = StageQueue("Process -> Encode", queue_size, stop)
+    writer = VideoWriter(output_file, clip.size, clip.fps)
+
+    def decode():
+        try:
+            for frame in tracing.traced_iter(clip.iter_frames(), "Decode"):
+                if not decoded.put(frame):
+                    return
+        finally:
+            decoded.put(_END)
+
+    def encode():
+        while True:
+            frame = processed.get()
+            if frame is _END:
+                break
+            writer.write(frame)
+
+    decoder = StageThread("decoder", decode, stop)
+    encoder = StageThread("encoder", encode, stop)
+
+    Log.subsection("Processing Video (threaded, queue size: %d) ..." % queue_size)
+    decoder.start()
+    encoder.start()
+    try:
+        while True:
+            frame = decoded.get()
+            if frame is _END:
+                break
+            if not processed.put(tracker.process_image(frame)):
+                break
+    except BaseException:
+        # processing failed, release the decoder and the encoder
+        stop.set()
+        raise
+    finally:
+        processed.put(_END)
+        encoder.join()
+        decoder.join()
+        # always stop ffmpeg, after a failure its close errors would hide the first one
+        if stop.is_set():
+            try:
+                writer.close()
+            except Exception:
+                pass
+        else:
+            writer.close()
+
+    # the first failure stops the other stages, raise it
+    encoder.join_checked()
+    decoder.join_checked()
+
+    Log.subsection("Pipeline Queues ...")
+    decoded.display_stats()
+    processed.display_stats()
+
+    return clip
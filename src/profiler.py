@@ -1,20 +1,245 @@
+import os
+import sys
+import csv
+import json
 import time
+import functools
+import tracemalloc
+from array import array
 from datetime import timedelta
 
+import numpy as np
+
+from src import tracing
 from src.logger import Log
 
+# memory accounting, see enable_memory_tracking()
+_memory = False
+
+# [start, peak] traced bytes of the spans being measured, to nest them
+_active_spans = []
+
+
+def enable_memory_tracking(frames=1):
+    """
+    Starts recording the allocations of every Profiler span with tracemalloc,
+    plus the process RSS at the end of each span. Python allocations get
+    noticeably slower while tracing, so this is for diagnosis runs only.
+
+    tracemalloc is process wide: with concurrent threads (see pipeline.py) the
+    allocations of the other threads are counted too.
+    """
+    global _memory
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _memory = True
+
+
+def is_memory_tracking():
+    return _memory
+
+
+def disable_memory_tracking():
+    global _memory
+    _memory = False
+    del _active_spans[:]
+    tracemalloc.stop()
+
+
+# without procfs get_rss falls back to the peak RSS of the process
+RSS_IS_PEAK = not os.path.exists("/proc/self/statm")
+
+
+def get_rss():
+    """Resident set size of the process in bytes (its peak if RSS_IS_PEAK)."""
+    if RSS_IS_PEAK:
+        import resource
+
+        # kB, but bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def start_memory_span():
+    current, peak = tracemalloc.get_traced_memory()
+    # the peak is reset for this span, keep it for the enclosing ones first
+    for span in _active_spans:
+        span[1] = max(span[1], peak)
+    tracemalloc.reset_peak()
+    span = [current, current]
+    _active_spans.append(span)
+    return span
+
+
+def end_memory_span(span):
+    """Returns the peak and net traced bytes of the span, above its start."""
+    current, peak = tracemalloc.get_traced_memory()
+    for active in _active_spans:
+        active[1] = max(active[1], peak)
+    # by identity, spans with the same values are different spans
+    _active_spans[:] = [active for active in _active_spans if active is not span]
+    return span[1] - span[0], current - span[0]
+
+
+class SampleBuffer(object):
+    """Last max_samples int64 values of a stream, in a ring buffer."""
+
+    def __init__(self, max_samples):
+        self.values = array("q")
+        self.max_samples = max_samples
+        self.count = 0
+
+    def append(self, value):
+        if len(self.values) < self.max_samples:
+            self.values.append(value)
+        else:
+            self.values[self.count % self.max_samples] = value
+        self.count += 1
+
+    def since(self, mark):
+        """Values appended after count was mark, oldest first (if still kept)."""
+        n = min(self.count - mark, len(self.values))
+        if n <= 0:
+            return []
+        if len(self.values) < self.max_samples:
+            return list(self.values[-n:])
+        end = self.count % self.max_samples
+        ordered = self.values[end:] + self.values[:end]
+        return list(ordered[-n:])
+
+    def last(self):
+        return self.values[(self.count - 1) % self.max_samples]
+
+    def to_numpy(self):
+        """Kept values, in no particular order."""
+        return np.frombuffer(self.values, dtype=np.int64)
+
 
 class Profiler(object):
-    def __init__(self, name):
+    """
+    Records one sample per start()/update() pair (e.g. per frame) with
+    perf_counter_ns. Count, total, min and max are exact; percentiles are
+    computed over the last max_samples samples, so memory stays bounded on
+    long streams.
+
+    Usable as a context manager or decorator, and child(name) gives a nested
+    span named "parent/name".
+
+    With enable_memory_tracking(), each sample also records the peak bytes
+    allocated during the span above its start (its temporaries and outputs),
+    the net bytes still allocated at its end and the process RSS. The total is
+    the sum of the peaks, a lower bound of the bytes allocated by the span.
+    """
+
+    def __init__(self, name, parent=None, max_samples=100000):
         self.name = name
-        self.elapsed = 0
+        self.parent = parent
+        self.children = dict()
+        self.max_samples = max_samples
         self.start_time = None
 
+        # samples [ns]
+        self.samples = SampleBuffer(max_samples)
+        self.n_samples = 0
+        self.elapsed_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+
+        # memory samples [bytes], see enable_memory_tracking()
+        self.memory_span = None
+        self.peaks = SampleBuffer(max_samples)
+        self.nets = SampleBuffer(max_samples)
+        self.max_peak = 0
+        self.peak_bytes = 0
+        self.net_bytes = 0
+        self.max_rss = 0
+
     def start(self):
-        self.start_time = time.time()
+        if _memory:
+            self.memory_span = start_memory_span()
+        self.start_time = time.perf_counter_ns()
 
     def update(self):
-        self.elapsed += time.time() - self.start_time
+        end_ns = time.perf_counter_ns()
+        self.record(end_ns - self.start_time)
+        tracing.record(self.name, self.start_time, end_ns)
+        if self.memory_span is not None:
+            self.record_memory(*end_memory_span(self.memory_span))
+            self.memory_span = None
+
+    def record(self, ns):
+        self.samples.append(ns)
+        self.n_samples += 1
+        self.elapsed_ns += ns
+        self.min_ns = ns if self.min_ns is None else min(self.min_ns, ns)
+        self.max_ns = ns if self.max_ns is None else max(self.max_ns, ns)
+
+    def record_memory(self, peak, net, rss=None):
+        self.peaks.append(peak)
+        self.nets.append(net)
+        self.max_peak = max(self.max_peak, peak)
+        self.peak_bytes += peak
+        self.net_bytes += net
+        self.max_rss = max(self.max_rss, get_rss() if rss is None else rss)
+
+    def add_samples(self, samples, peaks=(), nets=(), rss=0):
+        """Adds samples measured elsewhere, e.g. in a worker process."""
+        for ns in samples:
+            self.record(ns)
+        for peak, net in zip(peaks, nets):
+            self.record_memory(peak, net, rss)
+
+    def mark(self):
+        """Position to get the samples recorded after it, see samples_since."""
+        return self.samples.count, self.peaks.count
+
+    def samples_since(self, mark):
+        return self.samples.since(mark[0])
+
+    def peaks_since(self, mark):
+        return self.peaks.since(mark[1])
+
+    def nets_since(self, mark):
+        return self.nets.since(mark[1])
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.update()
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # a local start time keeps recursive/reentrant calls correct
+            memory_span = start_memory_span() if _memory else None
+            start_time = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end_ns = time.perf_counter_ns()
+                self.record(end_ns - start_time)
+                tracing.record(self.name, start_time, end_ns)
+                if memory_span is not None:
+                    self.record_memory(*end_memory_span(memory_span))
+
+        return wrapper
+
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Profiler(
+                self.name + "/" + name, self, self.max_samples
+            )
+        return self.children[name]
+
+    def walk(self):
+        yield self
+        for child in self.children.values():
+            for profiler in child.walk():
+                yield profiler
 
     def fmt_timedelta(self, delta):
         return str(delta).split(".")[0]
@@ -23,19 +248,132 @@ class Profiler(object):
         return self.fmt_timedelta(timedelta(seconds=seconds))
 
     def get_elapsed(self):
-        return self.elapsed
+        return self.elapsed_ns / 1e9
+
+    def get_last(self):
+        """Last sample [s], None before the first one."""
+        return self.samples.last() / 1e9 if self.n_samples else None
 
     def get_elapsed_str(self):
-        return self.fmt_seconds(self.elapsed)
+        return self.fmt_seconds(self.get_elapsed())
+
+    def get_stats(self):
+        """Per sample statistics in milliseconds."""
+        stats = dict(name=self.name, count=self.n_samples, total_s=self.get_elapsed())
+        if self.n_samples == 0:
+            return stats
+
+        samples_ms = self.samples.to_numpy() / 1e6
+        p50, p95, p99 = np.percentile(samples_ms, [50, 95, 99])
+        stats.update(
+            min_ms=self.min_ns / 1e6,
+            mean_ms=self.elapsed_ns / self.n_samples / 1e6,
+            p50_ms=float(p50),
+            p95_ms=float(p95),
+            p99_ms=float(p99),
+            max_ms=self.max_ns / 1e6,
+        )
+
+        if self.peaks.count > 0:
+            peaks_mb = self.peaks.to_numpy() / 2**20
+            stats.update(
+                alloc_peak_mean_mb=self.peak_bytes / self.peaks.count / 2**20,
+                alloc_peak_p95_mb=float(np.percentile(peaks_mb, 95)),
+                alloc_peak_max_mb=self.max_peak / 2**20,
+                alloc_total_mb=self.peak_bytes / 2**20,
+                alloc_net_mean_mb=self.net_bytes / self.peaks.count / 2**20,
+                rss_max_mb=self.max_rss / 2**20,
+            )
+        return stats
 
     def display_elapsed(self, total):
-        percent = 100 * self.elapsed / total
+        percent = 100 * self.get_elapsed() / total
         name = self.name.ljust(30)
         elapsed = self.get_elapsed_str()
         Log.info("%s:  %s (%5.1f%%)" % (name, elapsed, percent))
 
+    def display_stats(self):
+        stats = self.get_stats()
+        name = self.name.ljust(30)
+        if stats["count"] == 0:
+            Log.info("%s:  no samples" % name)
+            return
+        Log.info(
+            "%s:  n=%5d  min %7.2f  mean %7.2f  p50 %7.2f  p95 %7.2f  p99 %7.2f  max %7.2f ms"
+            % (
+                name,
+                stats["count"],
+                stats["min_ms"],
+                stats["mean_ms"],
+                stats["p50_ms"],
+                stats["p95_ms"],
+                stats["p99_ms"],
+                stats["max_ms"],
+            )
+        )
+        if "alloc_peak_max_mb" in stats:
+            Log.info(
+                "%s   alloc peak mean %7.2f  p95 %7.2f  max %7.2f MB, total %9.1f MB, net mean %+7.2f MB, %s %7.1f MB"
+                % (
+                    " " * len(name),
+                    stats["alloc_peak_mean_mb"],
+                    stats["alloc_peak_p95_mb"],
+                    stats["alloc_peak_max_mb"],
+                    stats["alloc_total_mb"],
+                    stats["alloc_net_mean_mb"],
+                    "process RSS peak" if RSS_IS_PEAK else "RSS max",
+                    stats["rss_max_mb"],
+                )
+            )
+
     def display_processing_factor(self, original_secs):
-        factor = self.elapsed / original_secs
+        elapsed = self.get_elapsed()
+        factor = elapsed / original_secs
         Log.info("Processing Time Factor = x%.1f" % factor)
         Log.info("    Original Duration  = %.2f s" % original_secs)
-        Log.info("    Elapsed Time       = %.2f s" % self.elapsed)
+        Log.info("    Elapsed Time       = %.2f s" % elapsed)
+
+
+STATS_COLUMNS = [
+    "name",
+    "count",
+    "total_s",
+    "min_ms",
+    "mean_ms",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+    "alloc_peak_mean_mb",
+    "alloc_peak_p95_mb",
+    "alloc_peak_max_mb",
+    "alloc_total_mb",
+    "alloc_net_mean_mb",
+    "rss_max_mb",
+]
+
+
+def export_profilers(profilers, fname, with_samples=False):
+    """Writes the statistics of profilers (and their children) as JSON or CSV."""
+    all_profilers = [p for profiler in profilers for p in profiler.walk()]
+    Log.info("Saving profiling results to %s" % fname)
+
+    if fname.endswith(".csv"):
+        with open(fname, "w", newline="") as f:
+            writer = csv.DictWriter(f, STATS_COLUMNS)
+            writer.writeheader()
+            for profiler in all_profilers:
+                writer.writerow(profiler.get_stats())
+        return
+
+    data = []
+    for profiler in all_profilers:
+        stats = profiler.get_stats()
+        if with_samples:
+            stats["samples_ns"] = profiler.samples.since(0)
+            if profiler.peaks.count > 0:
+                stats["alloc_peak_bytes"] = profiler.peaks.since(0)
+                stats["alloc_net_bytes"] = profiler.nets.since(0)
+        data.append(stats)
+    with open(fname, "w") as f:
+        json.dump(data, f, indent=2)
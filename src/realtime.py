@@ -0,0 +1,105 @@
+import time
+
+from .logger import Log
+
+
+class Level:
+    """Processing levels of a frame, from the most accurate to the cheapest."""
+
+    # whole pipeline
+    FULL = 0
+    # edge detection in the warp ROI, at a lower scale
+    REDUCED = 1
+    # no detection, the previous fits are extrapolated
+    PREDICT = 2
+
+    NAMES = ["full", "reduced", "predict"]
+
+
+class DeadlineController(object):
+    """
+    Picks the level of each frame to keep up with a frame budget [s], e.g.
+    1 / fps of a live camera.
+
+    Lateness is how far the stream is behind the budget, measured on the wall
+    clock between consecutive frames (so decoding, encoding or waiting for the
+    camera count too). The next frame gets the most accurate level whose
+    expected cost fits in the budget left after catching up. Expected costs
+    are running averages of the frame times measured at each level.
+
+    At most max_predicted frames in a row are predicted, so fits do not drift
+    away from the detections for long. A level unused for probe_interval frames
+    is tried again when the stream is on time, as its cost may have dropped
+    (e.g. the first frames include warmup costs).
+    """
+
+    def __init__(self, budget, max_predicted=5, smoothing=0.2, probe_interval=50):
+        self.budget = budget
+        self.max_predicted = max_predicted
+        self.smoothing = smoothing
+        self.probe_interval = probe_interval
+
+        self.last_time = None
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+        self.n_predicted = 0
+
+        # per level
+        self.costs = [None] * len(Level.NAMES)
+        self.counts = [0] * len(Level.NAMES)
+        self.last_used = [0] * len(Level.NAMES)
+        self.n_frames = 0
+
+    def next_level(self, has_fit):
+        now = time.perf_counter()
+        if self.last_time is not None:
+            # time ahead of the budget can not be saved for later frames
+            elapsed = now - self.last_time
+            self.lateness = max(self.lateness + elapsed - self.budget, 0.0)
+            self.max_lateness = max(self.max_lateness, self.lateness)
+        self.last_time = now
+
+        levels = [Level.FULL, Level.REDUCED]
+        if has_fit and self.n_predicted < self.max_predicted:
+            levels.append(Level.PREDICT)
+
+        # unknown costs are tried once to be measured
+        available = self.budget - self.lateness
+        for level in levels:
+            cost = self.costs[level]
+            if cost is None or cost <= available:
+                return level
+            if (
+                self.lateness == 0
+                and self.n_frames - self.last_used[level] >= self.probe_interval
+            ):
+                return level
+        return levels[-1]
+
+    def update(self, level, seconds):
+        """Frame time [s] measured for a frame processed at level."""
+        cost = self.costs[level]
+        if cost is None:
+            self.costs[level] = seconds
+        else:
+            self.costs[level] = cost + self.smoothing * (seconds - cost)
+        self.counts[level] += 1
+        self.n_frames += 1
+        self.last_used[level] = self.n_frames
+        self.n_predicted = self.n_predicted + 1 if level == Level.PREDICT else 0
+
+    def display_stats(self):
+        total = sum(self.counts)
+        Log.info("Frame budget                  :  %.1f ms" % (1000 * self.budget))
+        for level, name in enumerate(Level.NAMES):
+            count = self.counts[level]
+            percent = 100 * count / total if total else 0.0
+            cost = self.costs[level]
+            cost_str = "%7.2f ms" % (1000 * cost) if cost is not None else "      -"
+            Log.info(
+                "%s:  %5d frames (%5.1f%%), cost %s"
+                % (name.ljust(30), count, percent, cost_str)
+            )
+        Log.info(
+            "Max lateness                  :  %.1f ms" % (1000 * self.max_lateness)
+        )
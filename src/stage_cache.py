@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+
+import cv2
+import numpy as np
+
+from . import tracing
+from .logger import Log
+from .cache import Cache
+from .video_io import open_clip, VideoWriter
+
+
+def hash_config(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def hash_video(input_file, head_bytes=1 << 20):
+    """Identifies a video file by its size, modification time and first bytes."""
+    st = os.stat(input_file)
+    sha = hashlib.sha1()
+    sha.update(("%d:%d" % (st.st_size, st.st_mtime_ns)).encode())
+    with open(input_file, "rb") as f:
+        sha.update(f.read(head_bytes))
+    return sha.hexdigest()
+
+
+class StageCache(object):
+    """
+    Per frame outputs of the pipeline stages for one input video.
+
+    Each stage key hashes the video, the configuration of the stage and the key
+    of the stage it reads from, so changing a parameter only invalidates the
+    stages downstream of it. Binaries are bit-packed, color frames are stored as
+    PNG (lossless, fast compression level).
+    """
+
+    # stage: undistorted -> edges -> warped
+    UNDISTORTED = "undistorted"
+    EDGES = "edges"
+    WARPED = "warped"
+
+    def __init__(self, input_file, tracker, subclip_seconds=None, max_bytes=8 << 30):
+        self.cache = Cache("stages", version=2, max_bytes=max_bytes)
+        self.video_key = hash_config(hash_video(input_file), subclip_seconds)
+
+        undistorted = hash_config(self.video_key, tracker.camera.cache_key)
+        edges = hash_config(
+            undistorted,
+            tracker.edge_mode,
+            tracker.edge_detector.get_config(),
+            tracker.scaled_warper.src.tolist(),
+        )
+        warped = hash_config(edges, tracker.scaled_warper.M.tolist())
+        self.keys = {
+            self.UNDISTORTED: undistorted[:16],
+            self.EDGES: edges[:16],
+            self.WARPED: warped[:16],
+        }
+
+        self.hits = dict((stage, 0) for stage in self.keys)
+        self.misses = dict((stage, 0) for stage in self.keys)
+
+    def frame_key(self, stage, index):
+        return "%s_%s_%06d" % (stage, self.keys[stage], index)
+
+    def has(self, stage, index):
+        return self.cache.exists(self.frame_key(stage, index))
+
+    def save_binary(self, stage, index, binary):
+        packed = np.packbits(binary, axis=-1)
+        header = np.array(binary.shape, dtype=np.int64)
+        self.cache.put_array(
+            self.frame_key(stage, index),
+            np.concatenate((header.view(np.uint8), packed.ravel())),
+        )
+
+    def load_binary(self, stage, index):
+        data = self.load(stage, index)
+        if data is None:
+            return None
+        h, w = np.array(data[:16]).view(np.int64)
+        packed = np.array(data[16:]).reshape(h, -1)
+        return np.unpackbits(packed, axis=-1, count=w)
+
+    def save_image(self, stage, index, image):
+        _, png = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        self.cache.put_array(self.frame_key(stage, index), png.ravel())
+
+    def load_image(self, stage, index):
+        data = self.load(stage, index)
+        if data is None:
+            return None
+        return cv2.imdecode(np.array(data), cv2.IMREAD_UNCHANGED)
+
+    def load(self, stage, index):
+        data = self.cache.get_array(self.frame_key(stage, index))
+        if data is None:
+            self.misses[stage] += 1
+        else:
+            self.hits[stage] += 1
+        return data
+
+    def get_n_frames(self):
+        """Number of frames of the video, known after a first complete pass."""
+        meta = self.cache.get_meta("video_%s" % self.video_key[:16])
+        return None if meta is None else meta["n_frames"]
+
+    def set_n_frames(self, n_frames):
+        self.cache.put_meta("video_%s" % self.video_key[:16], dict(n_frames=n_frames))
+
+    def is_complete(self, stages, n_frames):
+        for index in range(n_frames):
+            for stage in stages:
+                if not self.has(stage, index):
+                    return False
+        return True
+
+    def display_stats(self):
+        for stage in (self.UNDISTORTED, self.EDGES, self.WARPED):
+            name = stage.ljust(30)
+            hits = self.hits[stage]
+            misses = self.misses[stage]
+            Log.info("%s:  %d hits, %d misses" % (name, hits, misses))
+
+
+def process_video_cached(tracker, input_file, output_file, subclip_seconds=None):
+    """
+    Processes the video reusing the stage outputs cached by earlier runs. When
+    every frame needed by this run is cached, the video is not decoded at all.
+    """
+    stage_cache = StageCache(input_file, tracker, subclip_seconds)
+    tracker.stage_cache = stage_cache
+
+    # clip metadata only, frames are decoded on iteration
+    clip = open_clip(input_file, subclip_seconds)
+
+    needed = tracker.get_cached_stages()
+    n_frames = stage_cache.get_n_frames()
+    if n_frames is not None and stage_cache.is_complete(needed, n_frames):
+        Log.subsection("Processing Video from the stage cache (no decoding) ...")
+        frames = (None for _ in range(n_frames))
+    else:
+        Log.subsection("Processing Video, filling the stage cache ...")
+        frames = tracing.traced_iter(clip.iter_frames(), "Decode")
+
+    n_frames = 0
+    try:
+        with VideoWriter(output_file, clip.size, clip.fps) as writer:
+            for result in tracker.process_stream(frames):
+                frame = result.overlay
+                writer.write(tracker.undistorted if frame is None else frame)
+                n_frames += 1
+    finally:
+        tracker.stage_cache = None
+    stage_cache.set_n_frames(n_frames)
+
+    Log.subsection("Stage Cache ...")
+    stage_cache.display_stats()
+    return clip
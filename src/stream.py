@@ -0,0 +1,84 @@
+"""
+Raw video streaming through stdin/stdout, e.g.:
+
+    ffmpeg -i project_video.mp4 -f rawvideo -pix_fmt rgb24 - \\
+        | python -m src.stream --width 1280 --height 720 \\
+        | ffplay -f rawvideo -pixel_format rgb24 -video_size 1280x720 -
+
+With --output jsonl one JSON line of lane geometry is written per frame instead
+of the overlay frames. Logs go to stderr.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from .logger import Log
+from .lane_tracker import LaneLinesTracker
+from .visualization import VisLevel
+
+
+def read_raw_frames(stream, width, height):
+    """Yields (height, width, 3) uint8 RGB frames from a rawvideo byte stream."""
+    frame_size = width * height * 3
+    while True:
+        buffer = bytearray(frame_size)
+        view = memoryview(buffer)
+        n_read = 0
+        while n_read < frame_size:
+            n = stream.readinto(view[n_read:])
+            if not n:
+                break
+            n_read += n
+        if n_read < frame_size:
+            if n_read > 0:
+                Log.warn("Dropping incomplete frame (%d bytes)" % n_read)
+            return
+        yield np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+
+
+def write_raw_frame(stream, frame):
+    stream.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lane tracking on rawvideo rgb24")
+    parser.add_argument("--width", type=int, required=True)
+    parser.add_argument("--height", type=int, required=True)
+    parser.add_argument("--output", choices=["overlay", "jsonl"], default="overlay")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument(
+        "--fps", type=float, default=None, help="real-time mode for a live source"
+    )
+    args = parser.parse_args()
+
+    # stdout carries the data
+    Log.file = sys.stderr
+
+    vis_level = VisLevel.OVERLAY if args.output == "overlay" else VisLevel.NONE
+    frame_budget = 1 / args.fps if args.fps else None
+    tracker = LaneLinesTracker(
+        vis_level=vis_level, scale=args.scale, frame_budget=frame_budget
+    )
+    frames = read_raw_frames(sys.stdin.buffer, args.width, args.height)
+
+    out = sys.stdout.buffer
+    try:
+        for result in tracker.process_stream(frames):
+            if args.output == "overlay":
+                write_raw_frame(out, result.overlay)
+            else:
+                out.write((json.dumps(result.to_dict()) + "\n").encode())
+            out.flush()
+    except BrokenPipeError:
+        # the reader went away (e.g. | head): stop quietly like a shell filter,
+        # stdout goes to devnull so the flush at exit does not fail again
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import csv
+
+import cv2
+import numpy as np
+
+from .logger import Log
+from .filtering import EdgeDetector, EdgeWorkspace, Transform
+from .lane_fitting import LaneFit
+from .visualization import VisLevel
+from .video_io import open_clip
+
+# configurations evaluated together, one bit each in a uint64 mask
+GROUP_SIZE = 64
+
+# direction (0..pi/2 rad) is quantized to uint8 to use lookup tables
+DIR_SCALE = 255 / (np.pi / 2)
+
+THRESHOLDS = [
+    "s_threshold",
+    "sx_threshold",
+    "sy_threshold",
+    "mag_threshold",
+    "dir_threshold",
+]
+
+
+def default_config():
+    """EdgeDetector thresholds, as a sweep configuration."""
+    return dict((name, getattr(EdgeDetector, name)) for name in THRESHOLDS)
+
+
+def range_lut(lo, hi):
+    values = np.arange(256)
+    return (values >= lo) & (values <= hi)
+
+
+def dir_lut(threshold):
+    lo, hi = Transform.deg_to_rad(threshold[0], threshold[1])
+    values = np.arange(256) / DIR_SCALE
+    return (values >= lo) & (values <= hi)
+
+
+class ThresholdSweep(object):
+    """
+    Evaluates many EdgeDetector threshold configurations on the same frames.
+
+    The expensive intermediates (HLS S channel, Sobel x/y, magnitude and
+    direction) are computed once per frame. Each threshold becomes a 256 entry
+    lookup table holding one bit per configuration, so one lookup per channel
+    evaluates up to 64 configurations at once:
+
+        mask = s | (sx & sy) | (mag & dir)
+
+    Note: the direction is quantized to 256 levels (~0.35 deg) and masks are
+    warped with nearest neighbor interpolation.
+    """
+
+    def __init__(self, configs, kernel_size=13, warper=None):
+        self.configs = [dict(default_config(), **config) for config in configs]
+        self.detector = EdgeDetector(vis_level=VisLevel.NONE)
+        self.detector.sobel.kernel_size = kernel_size
+        self.warper = warper
+        self.workspace = None
+
+        # one set of lookup tables per group of configurations
+        self.groups = []
+        for start in range(0, len(self.configs), GROUP_SIZE):
+            group = self.configs[start : start + GROUP_SIZE]
+            self.groups.append((start, len(group), self.build_luts(group)))
+
+    def build_luts(self, group):
+        luts = dict((name, np.zeros(256, np.uint64)) for name in THRESHOLDS)
+        for bit, config in enumerate(group):
+            for name in THRESHOLDS:
+                if name == "dir_threshold":
+                    passes = dir_lut(config[name])
+                else:
+                    passes = range_lut(*config[name])
+                luts[name] |= passes.astype(np.uint64) << np.uint64(bit)
+        return luts
+
+    def intermediates(self, image):
+        """8 bit channels shared by all configurations."""
+        if self.workspace is None or not self.workspace.fits(image.shape):
+            self.workspace = EdgeWorkspace(image.shape)
+        ws = self.workspace
+        sobel = self.detector.sobel
+
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=ws.gray)
+        _, s_channel = self.detector.hls.filter_s(image, ws=ws)
+        _, sx_scaled, sobel_x = sobel.filter_x(gray, ws=ws)
+        _, sy_scaled, sobel_y = sobel.filter_y(gray, ws=ws)
+        _, smag_scaled, _ = sobel.filter_mag(sobel_x, sobel_y, ws=ws)
+        _, sobel_dir = sobel.filter_dir(sobel_x, sobel_y, ws=ws)
+        dir_scaled = cv2.convertScaleAbs(sobel_dir, alpha=DIR_SCALE)
+
+        return dict(
+            s_threshold=s_channel,
+            sx_threshold=sx_scaled,
+            sy_threshold=sy_scaled,
+            mag_threshold=smag_scaled,
+            dir_threshold=dir_scaled,
+        )
+
+    def group_bits(self, channels, luts):
+        """uint64 image, bit k set where configuration k of the group detects."""
+        s = luts["s_threshold"][channels["s_threshold"]]
+        sx = luts["sx_threshold"][channels["sx_threshold"]]
+        sx &= luts["sy_threshold"][channels["sy_threshold"]]
+        mag = luts["mag_threshold"][channels["mag_threshold"]]
+        mag &= luts["dir_threshold"][channels["dir_threshold"]]
+        s |= sx
+        s |= mag
+        return s
+
+    def warp_bits(self, bits):
+        """Warps the 64 bit planes as 8 uint8 channels (nearest neighbor)."""
+        h, w = bits.shape
+        planes = bits.astype("<u8").view(np.uint8).reshape(h, w, 8)
+        M = self.warper.M
+        warped = [
+            cv2.warpPerspective(
+                np.ascontiguousarray(planes[:, :, c : c + 4]),
+                M,
+                (w, h),
+                flags=cv2.INTER_NEAREST,
+            )
+            for c in (0, 4)
+        ]
+        return np.concatenate(warped, axis=2)
+
+    def masks(self, image, warped=False):
+        """Yields (config index, uint8 0/1 mask) for every configuration."""
+        channels = self.intermediates(image)
+        for start, n, luts in self.groups:
+            bits = self.group_bits(channels, luts)
+            if warped:
+                planes = self.warp_bits(bits)
+                for bit in range(n):
+                    plane = planes[:, :, bit // 8]
+                    yield start + bit, (plane >> (bit % 8)) & 1
+            else:
+                for bit in range(n):
+                    mask = (bits >> np.uint64(bit)) & np.uint64(1)
+                    yield start + bit, mask.astype(np.uint8)
+
+    def evaluate(self, image):
+        """Per configuration detection and lane fitting metrics for one frame."""
+        h, w = image.shape[:2]
+        metrics = []
+        for index, mask in self.masks(image, warped=True):
+            lane_fitting = LaneFit(w, h, vis_level=VisLevel.NONE)
+            row = dict(config=index, edge_pixels=int(np.count_nonzero(mask)))
+            try:
+                lane_fitting.fit_polynomial(mask)
+            except (TypeError, ValueError, np.linalg.LinAlgError):
+                row["ok"] = False
+                metrics.append(row)
+                continue
+
+            leftx, _, rightx, _ = lane_fitting.lane_pixels
+            left_cr, right_cr = lane_fitting.get_curvature()
+            y = lane_fitting.target_px
+            width = np.polyval(lane_fitting.right_fit, y) - np.polyval(
+                lane_fitting.left_fit, y
+            )
+            row.update(
+                ok=bool(
+                    lane_fitting.is_sane(lane_fitting.left_fit, lane_fitting.right_fit)
+                ),
+                left_pixels=len(leftx),
+                right_pixels=len(rightx),
+                lane_width_px=float(width),
+                curvature_left=float(left_cr),
+                curvature_right=float(right_cr),
+                position=float(lane_fitting.get_vehicle_position()),
+            )
+            metrics.append(row)
+        return metrics
+
+
+def sweep_video(tracker, input_file, configs, subclip_seconds=None, results_file=None):
+    """
+    Evaluates threshold configurations over a video (or frame store), undistorting
+    each frame once with the tracker camera. Returns one summary row per
+    configuration: failure rate, mean edge/lane pixels and the frame to frame
+    stability (std) of lane width and vehicle position.
+    """
+    sweep = ThresholdSweep(
+        configs, tracker.edge_detector.sobel.kernel_size, tracker.warper
+    )
+    clip = open_clip(input_file, subclip_seconds)
+
+    Log.subsection("Sweeping %d configurations ..." % len(sweep.configs))
+    per_config = [[] for _ in sweep.configs]
+    for frame in clip.iter_frames():
+        undistorted = tracker.camera.undistort(frame)
+        for row in sweep.evaluate(undistorted):
+            per_config[row["config"]].append(row)
+
+    summary = []
+    for index, (config, rows) in enumerate(zip(sweep.configs, per_config)):
+        ok = [row for row in rows if row["ok"]]
+        entry = dict(config=index, frames=len(rows))
+        entry.update(config)
+        entry["failure_rate"] = 1 - len(ok) / len(rows) if rows else 0.0
+        entry["edge_pixels"] = float(np.mean([row["edge_pixels"] for row in rows]))
+        if ok:
+            lane_pixels = [row["left_pixels"] + row["right_pixels"] for row in ok]
+            entry["lane_pixels"] = float(np.mean(lane_pixels))
+            entry["lane_width_std"] = float(
+                np.std([row["lane_width_px"] for row in ok])
+            )
+            entry["position_std"] = float(np.std([row["position"] for row in ok]))
+        summary.append(entry)
+
+    if results_file:
+        Log.info("Saving sweep results to %s" % results_file)
+        columns = list(summary[0].keys()) if summary else []
+        for entry in summary:
+            columns += [c for c in entry if c not in columns]
+        with open(results_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows(summary)
+
+    return summary
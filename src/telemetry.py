@@ -0,0 +1,249 @@
+"""
+Telemetry-only analysis: per frame lane geometry, without rendering or encoding.
+
+    python -m src.telemetry project_video.mp4 output_videos/project_video.csv
+
+Rows are written to a table (.csv or .jsonl, from the file extension) and to a
+binary record file next to it (.npy, see TELEMETRY_DTYPE), every flush_interval
+frames, so memory stays constant on long videos. The record file header is
+updated on each flush: a run stopped early is readable up to its last flush.
+
+    records = np.load("output_videos/project_video.npy", mmap_mode="r")
+    records["position"], records["left_fit"][:, 0], ...
+"""
+
+import os
+import csv
+import json
+import struct
+import argparse
+
+import numpy as np
+
+from . import tracing
+from .logger import Log
+from .save import chmod_rw_all
+from .video_io import open_clip
+from .realtime import Level
+from .visualization import VisLevel
+
+TELEMETRY_DTYPE = np.dtype(
+    [
+        ("index", "<i8"),
+        ("time", "<f8"),
+        ("left_fit", "<f8", (3,)),
+        ("right_fit", "<f8", (3,)),
+        ("curvature", "<f8", (2,)),
+        ("position", "<f8"),
+        ("tracked", "?"),
+        ("level", "u1"),
+    ]
+)
+
+CSV_COLUMNS = [
+    "index",
+    "time",
+    "left_a",
+    "left_b",
+    "left_c",
+    "right_a",
+    "right_b",
+    "right_c",
+    "left_curvature",
+    "right_curvature",
+    "position",
+    "tracked",
+    "level",
+]
+
+# .npy header with room for any row count, rewritten in place on flush
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_HEADER_SIZE = 256
+
+
+def get_npy_header(dtype, n_rows):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype),
+        n_rows,
+    )
+    # spaces and a newline up to the fixed size, as numpy pads its own headers
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+TABLE_EXTENSIONS = (".csv", ".jsonl")
+
+
+def get_records_file(fname):
+    return os.path.splitext(fname)[0] + ".npy"
+
+
+class TelemetryWriter(object):
+    """
+    Streams LaneResult rows to fname (.csv or .jsonl) and to its .npy record
+    file, buffering flush_interval rows in a preallocated record array.
+    """
+
+    def __init__(self, fname, fps, flush_interval=500):
+        # the record file would overwrite a .npy table
+        if os.path.splitext(fname)[1] not in TABLE_EXTENSIONS:
+            raise ValueError("Telemetry file must be .csv or .jsonl: %s" % fname)
+
+        self.fname = fname
+        self.records_file = get_records_file(fname)
+        self.fps = fps
+        self.flush_interval = flush_interval
+
+        self.buffer = np.zeros(flush_interval, dtype=TELEMETRY_DTYPE)
+        self.n_buffered = 0
+        self.n_rows = 0
+
+        self.jsonl = fname.endswith(".jsonl")
+        self.table = open(fname, "w", newline="")
+        self.csv_writer = None
+        if not self.jsonl:
+            self.csv_writer = csv.writer(self.table)
+            self.csv_writer.writerow(CSV_COLUMNS)
+
+        self.records = open(self.records_file, "wb")
+        self.records.write(get_npy_header(TELEMETRY_DTYPE, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, result):
+        row = self.buffer[self.n_buffered]
+        row["index"] = result.index
+        row["time"] = result.index / self.fps
+        row["left_fit"] = result.left_fit
+        row["right_fit"] = result.right_fit
+        row["curvature"] = result.curvature
+        row["position"] = result.position
+        row["tracked"] = result.tracked
+        row["level"] = result.level
+        self.n_buffered += 1
+        if self.n_buffered == self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        rows = self.buffer[: self.n_buffered]
+        if self.jsonl:
+            self.write_jsonl(rows)
+        else:
+            self.write_csv(rows)
+        self.table.flush()
+
+        self.records.write(rows.tobytes())
+        self.n_rows += self.n_buffered
+        self.n_buffered = 0
+
+        # row count in the header, then back to the end for the next rows
+        self.records.seek(0)
+        self.records.write(get_npy_header(TELEMETRY_DTYPE, self.n_rows))
+        self.records.seek(0, os.SEEK_END)
+        self.records.flush()
+
+    def write_csv(self, rows):
+        # subarray fields stay numpy arrays
+        for row in rows.tolist():
+            index, time, left_fit, right_fit, curvature, position, tracked, level = row
+            self.csv_writer.writerow(
+                [index, "%.4f" % time]
+                + ["%.8g" % c for c in list(left_fit) + list(right_fit)]
+                + ["%.1f" % c for c in curvature]
+                + ["%.4f" % position, int(tracked), Level.NAMES[level]]
+            )
+
+    def write_jsonl(self, rows):
+        lines = []
+        # subarray fields stay numpy arrays
+        for row in rows.tolist():
+            index, time, left_fit, right_fit, curvature, position, tracked, level = row
+            data = dict(
+                index=index,
+                time=time,
+                left_fit=left_fit.tolist(),
+                right_fit=right_fit.tolist(),
+                curvature=curvature.tolist(),
+                position=position,
+                tracked=tracked,
+                level=Level.NAMES[level],
+            )
+            lines.append(json.dumps(data) + "\n")
+        self.table.write("".join(lines))
+
+    def close(self):
+        if self.n_buffered:
+            self.flush()
+        self.table.close()
+        self.records.close()
+        chmod_rw_all(self.fname)
+        chmod_rw_all(self.records_file)
+
+
+def process_video_telemetry(
+    tracker, input_file, telemetry_file, subclip_seconds=None, flush_interval=500
+):
+    """
+    Runs the tracker on every frame of the video without drawing or encoding,
+    writing the lane geometry of each frame to telemetry_file (see
+    TelemetryWriter). The tracker runs at VisLevel.NONE, its vis level is
+    restored afterwards.
+    """
+    clip = open_clip(input_file, subclip_seconds)
+
+    dirname = os.path.dirname(telemetry_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    Log.subsection("Processing Video (telemetry only) ...")
+    vis_level = tracker.vis_level
+    tracker.set_vis_level(VisLevel.NONE)
+    try:
+        with TelemetryWriter(telemetry_file, clip.fps, flush_interval) as writer:
+            frames = tracing.traced_iter(clip.iter_frames(), "Decode")
+            for result in tracker.process_stream(frames):
+                writer.write(result)
+    finally:
+        tracker.set_vis_level(vis_level)
+    Log.info("%d frames written to %s" % (writer.n_rows, telemetry_file))
+    Log.info("Records written to %s" % writer.records_file)
+    return clip
+
+
+def main():
+    from .lane_tracker import LaneLinesTracker, EdgeMode
+
+    parser = argparse.ArgumentParser(description="Per frame lane geometry of a video")
+    parser.add_argument("input_file")
+    parser.add_argument("telemetry_file", help=".csv or .jsonl, plus a .npy next to it")
+    parser.add_argument("--subclip", type=float, default=None, help="seconds")
+    parser.add_argument("--flush-interval", type=int, default=500, help="frames")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument(
+        "--edge-mode",
+        default=EdgeMode.FULL,
+        choices=[EdgeMode.FULL, EdgeMode.ROI, EdgeMode.WARP_FIRST, EdgeMode.POINTS],
+    )
+    parser.add_argument("--profile", help="profiling statistics (.json or .csv)")
+    args = parser.parse_args()
+
+    Log.section("Telemetry")
+    tracker = LaneLinesTracker(
+        edge_mode=args.edge_mode, vis_level=VisLevel.NONE, scale=args.scale
+    )
+    tracker.process_video(
+        args.input_file,
+        None,
+        args.subclip,
+        telemetry_file=args.telemetry_file,
+        flush_interval=args.flush_interval,
+        profile_file=args.profile,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Opt-in timeline tracing in Chrome trace-event format, viewable in Perfetto or
+chrome://tracing.
+
+Events are buffered in memory and only written by save(), so tracing does not
+add I/O to the timed code. Every Profiler span is traced while a tracer is
+enabled, tagged with the process, thread and current frame index.
+"""
+
+import os
+import json
+import time
+import itertools
+import threading
+import contextlib
+
+from .logger import Log
+
+# process wide tracer, None when tracing is disabled
+_tracer = None
+
+
+class Tracer(object):
+    def __init__(self):
+        self.events = []
+        self.thread_names = dict()
+        self.local = threading.local()
+
+    def set_frame(self, index):
+        """Frame index added to the events of the calling thread."""
+        self.local.frame = index
+
+    def add(self, name, start_ns, end_ns, **args):
+        thread = threading.current_thread()
+        key = (os.getpid(), thread.ident)
+        if key not in self.thread_names:
+            self.thread_names[key] = thread.name
+
+        frame = getattr(self.local, "frame", None)
+        if frame is not None:
+            args.setdefault("frame", frame)
+
+        # list.append is atomic, no lock needed between threads
+        self.events.append(
+            dict(
+                name=name,
+                cat="pipeline",
+                ph="X",
+                ts=start_ns / 1000.0,
+                dur=(end_ns - start_ns) / 1000.0,
+                pid=key[0],
+                tid=key[1],
+                args=args,
+            )
+        )
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start_ns, time.perf_counter_ns(), **args)
+
+    def drain(self):
+        """Returns and clears the buffered events, e.g. to send them from a worker."""
+        events = self.events
+        self.events = []
+        names = [dict(pid=p, tid=t, name=n) for (p, t), n in self.thread_names.items()]
+        return events, names
+
+    def merge(self, drained):
+        events, names = drained
+        self.events.extend(events)
+        for entry in names:
+            self.thread_names[(entry["pid"], entry["tid"])] = entry["name"]
+
+    def save(self, fname):
+        metadata = [
+            dict(ph="M", name="thread_name", pid=pid, tid=tid, args=dict(name=name))
+            for (pid, tid), name in self.thread_names.items()
+        ]
+        Log.info("Saving %d trace events to %s" % (len(self.events), fname))
+        with open(fname, "w") as f:
+            json.dump(dict(traceEvents=metadata + self.events), f)
+
+
+def enable():
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    return tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def record(name, start_ns, end_ns):
+    if _tracer is not None:
+        _tracer.add(name, start_ns, end_ns)
+
+
+def set_frame(index):
+    if _tracer is not None:
+        _tracer.set_frame(index)
+
+
+def span(name, **args):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, **args)
+
+
+def traced_iter(iterable, name):
+    """Traces the time spent producing each item, e.g. decoding frames."""
+    iterator = iter(iterable)
+    for index in itertools.count():
+        start_ns = time.perf_counter_ns()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if _tracer is not None:
+            _tracer.add(name, start_ns, time.perf_counter_ns(), frame=index)
+        yield item
@@ -0,0 +1,50 @@
+from moviepy.editor import VideoFileClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+from . import tracing
+from .logger import Log
+from .save import chmod_rw_all, delete_file
+from .frame_store import FrameStore, is_frame_store
+
+
+def open_clip(input_file, subclip_seconds=None):
+    """Opens a video file, or a decoded frame store (see frame_store.py)."""
+    Log.subsection("Reading video file: %s" % input_file)
+    if is_frame_store(input_file):
+        clip = FrameStore(input_file)
+    else:
+        clip = VideoFileClip(input_file, audio=False)
+
+    # subclip
+    if subclip_seconds:
+        Log.info("Clipping video to: %.1f s" % subclip_seconds)
+        clip = clip.subclip(0, subclip_seconds)
+
+    return clip
+
+
+class VideoWriter(object):
+    """Encodes RGB frames one by one, without keeping them in memory."""
+
+    def __init__(self, output_file, size, fps):
+        # delete output file to avoid permission problems between docker/user on write
+        delete_file(output_file)
+
+        self.output_file = output_file
+        self.writer = FFMPEG_VideoWriter(output_file, size, fps, codec="libx264")
+        self.n_frames = 0
+
+    def write(self, frame):
+        with tracing.span("Encode", frame=self.n_frames):
+            self.writer.write_frame(frame)
+        self.n_frames += 1
+
+    def close(self):
+        self.writer.close()
+        chmod_rw_all(self.output_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,9 @@
+class VisLevel:
+    """How much visualization work the pipeline does per frame."""
+
+    # lane geometry only, nothing is drawn
+    NONE = 0
+    # output overlay only
+    OVERLAY = 1
+    # overlay and intermediate debug images
+    DEBUG = 2